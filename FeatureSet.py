@@ -1,8 +1,142 @@
+import array
+import binascii
+import mmap
+import multiprocessing
+import re
+import struct
+from collections import OrderedDict
+
 ################################################
 ##      FEATURESET: feature magic             ##
 ################################################
 
-class FeatureSet:
+## Binary natural class files (see FeatureSet.savebinary) start with MAGIC
+## and BINARY_VERSION. Bump BINARY_VERSION whenever the layout changes.
+MAGIC = 'PHFS'
+BINARY_VERSION = 1
+HEADER = struct.Struct('<4sHIIII')
+
+## A bracketed feature string in a feature regex, e.g. [+syl,-back]
+FEATURE_RE = re.compile(r'\[[^\]]*\]')
+## How many compiled feature regexes a FeatureSet keeps (see REcompile)
+RE_CACHE_SIZE = 1024
+## Numeric feature values in the arrays yielded by FeatureSet.annotate
+FEATVALS = {'+': 1, '-': -1, '0': 0}
+
+## Levels of the natural class search with fewer classes than this are
+## extended in the main process even when getclasses runs in parallel
+PARALLEL_MIN_LEVEL = 256
+
+## Worker state for parallel natural class enumeration: for each feature
+## index, the masks of its '+' and '-' values (see FeatureSet.getclasses)
+_workerfeatmasks = None
+
+def _initworker(featmasks):
+    global _workerfeatmasks
+    _workerfeatmasks = featmasks
+
+def _extendlevel(parents, featmasks = None):
+    """Extends each parent class in a list by every feature value after
+    its last one, in the order FeatureSet.uppertriang does. A parent is a
+    (first feature index to extend by, mask) pair. Returns a list of
+    (parent position, feature index, value, mask) tuples for the non-empty
+    extensions, keeping only the first for each mask. Featspecs aren't
+    passed in or out, to keep what's sent between processes small."""
+    if featmasks is None: featmasks = _workerfeatmasks
+    nfeats, seen, found = len(featmasks), set(), []
+    for j, (start, parentmask) in enumerate(parents):
+        for iVal, featval in enumerate('+-'):
+            for i in xrange(start, nfeats):
+                mask = parentmask & featmasks[i][iVal]
+                if not mask or mask in seen: continue
+                seen.add(mask)
+                found.append((j, i, featval, mask))
+    return(found)
+
+def readCorpus(corpusfile):
+    """Generator over the words of a segmented corpus file: one word per
+    line, segments space-separated (as in panka_data.txt). Yields each
+    word's list of segments, skipping blank lines, without reading the
+    whole file."""
+    with open(corpusfile) as fin:
+        for line in fin:
+            segList = line.split()
+            if segList: yield segList
+
+def _mask2bytes(mask, width):
+    'Big-endian bytes of a bitmask, so that byte order matches int order.'
+    return(binascii.unhexlify('%0*x' % (2*width, mask)))
+
+def _bytes2mask(data):
+    return(int(binascii.hexlify(data), 16) if data else 0)
+
+class ClassTable(object):
+    """
+    Read-only dict-like view of the natural classes in a binary natural
+    class file, used as FeatureSet.classmasks when the file is loaded
+    lazily. The file is memory-mapped and nothing is decoded until it is
+    asked for: a lookup by mask is a binary search over the sorted,
+    fixed-width mask array, and only the matching featspec is unpacked.
+    """
+    def __init__(self, data, offset, nclasses, maskbytes):
+        self.data = data
+        self.nclasses = nclasses
+        self.maskbytes = maskbytes
+        self.maskstart = offset
+        self.indexstart = self.maskstart + nclasses*maskbytes
+        self.specstart = self.indexstart + 4*(nclasses+1)
+
+    def _mask(self, i):
+        start = self.maskstart + i*self.maskbytes
+        return(_bytes2mask(self.data[start:start+self.maskbytes]))
+
+    def _featspec(self, i):
+        start, end = struct.unpack_from('<II', self.data, \
+                self.indexstart + 4*i)
+        items = struct.unpack_from('<%dH' % (end-start), self.data, \
+                self.specstart + 2*start)
+        return([(item >> 1, '-' if item & 1 else '+') for item in items])
+
+    def _find(self, mask):
+        'Index of mask in the table, or -1.'
+        key = _mask2bytes(mask, self.maskbytes)
+        if len(key) != self.maskbytes: return(-1)
+        lo, hi = 0, self.nclasses
+        while lo < hi:
+            mid = (lo+hi) // 2
+            start = self.maskstart + mid*self.maskbytes
+            if self.data[start:start+self.maskbytes] < key: lo = mid+1
+            else: hi = mid
+        if lo < self.nclasses and self._mask(lo) == mask: return(lo)
+        return(-1)
+
+    def __len__(self):
+        return(self.nclasses)
+
+    def __contains__(self, mask):
+        return(self._find(mask) >= 0)
+
+    def __getitem__(self, mask):
+        i = self._find(mask)
+        if i < 0: raise KeyError(mask)
+        return(self._featspec(i))
+
+    def get(self, mask, default = None):
+        i = self._find(mask)
+        if i < 0: return(default)
+        return(self._featspec(i))
+
+    def __iter__(self):
+        for i in xrange(self.nclasses): yield self._mask(i)
+
+    def keys(self):
+        return(list(self))
+
+    def items(self):
+        return([(self._mask(i), self._featspec(i)) \
+                for i in xrange(self.nclasses)])
+
+class FeatureSet(object):
     """
     A FeatureSet object mediates between segments, features, natural
     classes, and regular expressions. FeatureSets are specified by
@@ -56,11 +190,36 @@ class FeatureSet:
     representation called a FEATSPEC, which is a list of
     (feature index, non-zero value) pairs. The entire set of *distinct*
     natural classes can be efficiently enumerated using this
-    representation (see enumerate for details). It is then stored in
+    representation (see enumerate for details).
+
+    Internally, every set of segments is a BITMASK: an integer whose bit i
+    is set iff self.segments[i] is in the set. The extension of each
+    (feature, value) pair is precomputed as such a mask, so the extension
+    of a featspec is just a chain of ANDs:
+--->    self.featmasks <dict> -- bitmask analogue of self.featdict
+            key: (feature name, value) <tuple>
+            value: segments with that feature value <int>
+--->    self.classmasks <dict> -- the distinct natural classes
+            key: bitmask of the segments in the natural class <int>
+            value: featspec which specified the class
+    The human-readable view of the same information is materialized on
+    demand (and cached until the classes change) as
 --->    self.natclasses <dict>
             key: tuple containing all segments in the natural class
             value: featspec which specified the class
+    For looking up the classes containing a segment (segclasses, seqclasses)
+    there is an inverted index, built along with the classes by getclasses
+    (or on first use, if the classes were loaded or assigned):
+        self._segclassmasks <list> -- for each segment index, the masks of
+            the natural classes containing that segment
     
+    The classes can be saved to and loaded from a text file (saveclasses,
+    loadclasses) or a compact binary file (savebinary, loadbinary). A
+    binary file also holds the segments and features, so it can be loaded
+    into an empty FeatureSet without the feature file; by default it is
+    memory-mapped and self.classmasks becomes a read-only ClassTable that
+    decodes classes only as they are looked up.
+
     There are internal functions which translate between featspecs
     and the corresponding (human-readable) feature string descriptors:
         str2featspec
@@ -70,38 +229,111 @@ class FeatureSet:
     natural class:
         featureStr2segList
         segList2featureStr
+    segList2featureStr gives the featspec that enumeration happened to
+    find first. mindescriptions and segList2minFeatureStr instead solve for
+    the shortest featspecs directly from the feature masks, and
+    enclosingclass finds the smallest natural class containing any set of
+    segments; none of these need the natural classes to be enumerated.
         
     The FeatureSet code is relatively autonomous. If you supply a feature
     file in the correct format, you can initialize the FeatureSet object
     by passing it the filename. It will fill in all the data structures,
-    including computing the natural classes, efficiently.
+    including computing the natural classes, efficiently. Pass lazy=True
+    to skip computing the natural classes: iterclasses can then stream
+    them (or just the first few levels) without storing them, and
+    getclasses computes them all when needed.
 
     """
-    def __init__(self, featfile = None):
+    def __init__(self, featfile = None, lazy = False):
         self.features = []
         self.segments = []
         self.segdict = {}
         self.featdict = {}
-        self.natclasses = {}
+        self.featmasks = {}
+        self.classmasks = {}
+        self._segindex = {}
+        self._featindex = {}
+        self._featrows = None
+        self._featvals = None
+        self._recache = OrderedDict()
+        self._classeschanged()
         if featfile:
             self.readFeatures(featfile)
-            self.getclasses()
+            if not lazy: self.getclasses()
         
     def readFeatures(self, featfile):
         """Reads in data from feature file. Header row should have initial
         whitespace and then feature names."""
         fin = open(featfile)
         self.features = fin.readline().split()
+        self._featindex = dict([(feat, i) for i, feat in \
+                enumerate(self.features)])
+        self._recache.clear()
         for line in fin:
             parse = line.split()
-            seg, featvals = parse[0], ''.join(parse[1:])
-            self.segments.append(seg)
-            self.segdict[seg] = featvals
-            for iFeat, featval in enumerate(featvals):
-                if featval == '0': continue
-                self.featdict[(self.features[iFeat],featval)] = sorted( \
-                    self.featdict.get((self.features[iFeat],featval),[])+[seg])
+            self._addsegment(parse[0], ''.join(parse[1:]))
         fin.close()
+        for key in self.featdict: self.featdict[key].sort()
+
+    def _addsegment(self, seg, featvals):
+        '''Adds a segment with the given feature value string to the
+        inventory while it is being read in. Nothing derived from the
+        inventory (the natural classes, compiled REs) is updated.'''
+        self._featrows = None
+        self._featvals = None
+        self._segindex[seg] = len(self.segments)
+        self.segments.append(seg)
+        self.segdict[seg] = featvals
+        segbit = 1 << self._segindex[seg]
+        for iFeat, featval in enumerate(featvals):
+            if featval == '0': continue
+            key = (self.features[iFeat],featval)
+            self.featdict.setdefault(key,[]).append(seg)
+            self.featmasks[key] = self.featmasks.get(key,0) | segbit
+
+    def _classeschanged(self):
+        'Forgets everything derived from self.classmasks.'
+        self._natclasses = None
+        self._segclassmasks = None
+        self._segclasskeys = {}
+        self._classorder = None
+        self._segclassbits = None
+
+    @property
+    def allmask(self):
+        'Bitmask containing every segment in the inventory.'
+        return((1 << len(self.segments)) - 1)
+
+    @property
+    def natclasses(self):
+        'Natural classes keyed by segment tuple, built from self.classmasks.'
+        if self._natclasses is None:
+            self._natclasses = dict([(self._classkey(mask), featspec) \
+                    for mask, featspec in self.classmasks.items()])
+        return(self._natclasses)
+
+    @natclasses.setter
+    def natclasses(self, natclasses):
+        self.classmasks = dict([(self.segs2mask(segs), featspec) \
+                for segs, featspec in natclasses.items()])
+        self._classeschanged()
+
+    def segs2mask(self, segList):
+        'Bitmask for a collection of segments. Unknown segments raise KeyError.'
+        mask = 0
+        for seg in segList: mask |= 1 << self._segindex[seg]
+        return(mask)
+
+    def mask2segs(self, mask):
+        'Sorted tuple of the segments in a bitmask.'
+        return(tuple(sorted([seg for i, seg in enumerate(self.segments) \
+                if mask >> i & 1])))
+
+    def _classkey(self, mask):
+        """The natclasses key for a class mask. The whole inventory has
+        always been keyed in feature file order rather than sorted."""
+        if mask == self.allmask: return(tuple(self.segments))
+        return(self.mask2segs(mask))
 
     def uppertriang(self, featspec):
         """ For enumeration. If input featspec specifies [+FeatureI,-FeatureJ],
@@ -117,36 +349,123 @@ class FeatureSet:
                [featspec+[(i,'-')] \
                     for i in range(featspec[-1][0]+1,len(self.features))])
 
-    def getclasses(self, outfile = None):
+    def getclasses(self, outfile = None, processes = 1):
         """ A featspec is a list of pairs [(i,b[i]), (i+j,b[i+j]), ...] where
             n is a feature index and where b[n] is a feature value (+/-).
         This function searches all featspecs in an order designed to allow for
-            efficient paring of redundant featspecs. """
-        self.natclasses[tuple(self.segments)] = []
-        nextspecs = [[(i,'+')] for i in range(len(self.features))] + \
+            efficient paring of redundant featspecs (see _iterclassmasks),
+        and stores every natural class in self.classmasks. If processes is
+        not 1, the extensions of each level are computed by that many
+        worker processes (None for one per CPU), with the same results. """
+        self.classmasks = {}
+        self._classeschanged()
+        self._segclassmasks = [[] for seg in self.segments]
+        for mask, featspec in self._iterclassmasks(processes = processes):
+            self.classmasks[mask] = featspec
+            self._indexclass(mask)
+
+    def _iterclassmasks(self, maxlength = None, processes = 1):
+        """Generator over the (mask, featspec) pairs of the natural classes,
+        level by level: the whole inventory, then the classes specified by
+        one feature, then by two, and so on, up to maxlength features. Each
+        class is yielded with the first featspec that picks it out, and only
+        that featspec is extended to the next level. Each candidate featspec
+        is extended from the mask of its parent, so computing its extension
+        costs a single AND. Only the classes found at the current level and
+        the set of masks seen so far are held in memory.
+
+        If processes is not 1, each large level is split into contiguous
+        chunks which a pool of worker processes extends (see _extendlevel).
+        The results are merged in chunk order at the end of the level, so
+        the first featspec for each class is the same as in a sequential
+        search."""
+        if processes != 1:
+            for item in self._iterclassmasksparallel(maxlength, processes):
+                yield item
+            return
+        allmask = self.allmask
+        seen = set([allmask])
+        yield allmask, []
+        firstspecs = [[(i,'+')] for i in range(len(self.features))] + \
                 [[(i,'-')] for i in range(len(self.features))]
-        while nextspecs:
-            featspecs, nextspecs = nextspecs, []
-            for featspec in featspecs:
-                natclass = tuple(sorted(self.getclass(featspec)))
-                if natclass in self.natclasses or not natclass: continue
-                self.natclasses[natclass] = featspec
-                nextspecs += self.uppertriang(featspec)
+        level, length = [([], allmask)], 0
+        while level and (maxlength is None or length < maxlength):
+            found, length = [], length+1
+            for parentspec, parentmask in level:
+                if parentspec: featspecs = self.uppertriang(parentspec)
+                else: featspecs = firstspecs
+                for featspec in featspecs:
+                    iFeat, featval = featspec[-1]
+                    mask = parentmask & \
+                        self.featmasks.get((self.features[iFeat],featval),0)
+                    if not mask or mask in seen: continue
+                    seen.add(mask)
+                    found.append((featspec, mask))
+                    yield mask, featspec
+            level = found
+
+    def _iterclassmasksparallel(self, maxlength, processes):
+        'The parallel version of _iterclassmasks.'
+        if processes is None: processes = multiprocessing.cpu_count()
+        featmasks = [(self.featmasks.get((feat,'+'),0), \
+                self.featmasks.get((feat,'-'),0)) for feat in self.features]
+        pool = multiprocessing.Pool(processes, _initworker, (featmasks,))
+        try:
+            allmask = self.allmask
+            seen = set([allmask])
+            yield allmask, []
+            level, length = [([], allmask)], 0
+            while level and (maxlength is None or length < maxlength):
+                found, length = [], length+1
+                parents = [(featspec[-1][0]+1 if featspec else 0, mask) \
+                        for featspec, mask in level]
+                if len(level) < PARALLEL_MIN_LEVEL:
+                    chunks = [_extendlevel(parents, featmasks)]
+                    size = len(level)
+                else:
+                    size = -(-len(level) // (4*processes))
+                    chunks = pool.map(_extendlevel, [parents[i:i+size] \
+                            for i in xrange(0, len(level), size)])
+                for iChunk, chunk in enumerate(chunks):
+                    for j, i, featval, mask in chunk:
+                        if mask in seen: continue
+                        seen.add(mask)
+                        featspec = level[iChunk*size+j][0] + [(i,featval)]
+                        found.append((featspec, mask))
+                        yield mask, featspec
+                level = found
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def iterclasses(self, maxlength = None, maxclasses = None):
+        """Generator over the natural classes as (segment tuple, featspec)
+        pairs, in the order getclasses finds them, without storing them.
+        Stops after the classes specified by maxlength features, or after
+        maxclasses classes, if given."""
+        for count, (mask, featspec) in \
+                enumerate(self._iterclassmasks(maxlength)):
+            if maxclasses is not None and count >= maxclasses: return
+            yield self._classkey(mask), featspec
 
     def featspec2str(self, featspec):
         'Generates a string representation of the inputted featspec'
         return(','.join([fTuple[1] + self.features[fTuple[0]] \
                 for fTuple in featspec]))
 
-    def featureStr2segList(self, featspecStr):
+    def str2featspec(self, featspecStr):
+        'Parses a feature string; unknown features are ignored.'
         featspec = []
         for featStr in featspecStr.split(','):
-            try: featspec.append((self.features.index(featStr[1:]), featStr[0]))
-            except ValueError: pass
-        return(self.getclass(featspec))
+            try: featspec.append((self._featindex[featStr[1:]], featStr[0]))
+            except KeyError: pass
+        return(featspec)
+
+    def featureStr2segList(self, featspecStr):
+        return(self.getclass(self.str2featspec(featspecStr)))
 
     def segList2featureStr(self, segList):
-        try: return(self.featspec2str(self.natclasses[tuple(sorted(segList))]))
+        try: return(self.featspec2str(self.classmasks[self.segs2mask(segList)]))
         except KeyError: raise ValueError, "Non-existent natural class %s" %str(segList)
 
     def saveclasses(self, outfile):
@@ -158,19 +477,188 @@ class FeatureSet:
                             '\t' + ' '.join(natclass)
 
     def loadclasses(self, infile):
-        """Loads natural classes. Expecting each class on its own line,
-        with segs sorted and space-separated."""
+        """Loads natural classes, as written by saveclasses. Expecting each
+        class on its own line: its feature string, a tab, and then its segs
+        space-separated."""
+        classmasks = dict(self.classmasks.items())
         with open(infile) as fin:
             for line in fin:
-                self.natclasses[tuple(line.split())] = 1
+                featspecStr, segs = line.rstrip('\r\n').split('\t')
+                classmasks[self.segs2mask(segs.split())] = \
+                        self.str2featspec(featspecStr)
+        self.classmasks = classmasks
+        self._classeschanged()
+
+    def savebinary(self, outfile):
+        """Writes the segments, features and natural classes to a binary
+        file. The layout (all integers little-endian) is:
+            header: MAGIC, BINARY_VERSION (uint16), number of segments,
+                features and classes, and the bytes per class mask (uint32s)
+            segment table: each segment as a uint16 length and its bytes,
+                followed by its feature value string (one byte per feature)
+            feature table: each feature name as a uint16 length and its bytes
+            class masks: one big-endian mask per class, in ascending order
+            featspec index: for each class, the uint32 offset of its featspec
+                in the featspec table, plus the end of the table
+            featspec table: each (feature index, value) pair as a uint16,
+                (index << 1) | (1 if value is '-' else 0)"""
+        maskbytes = max(1, (len(self.segments)+7) // 8)
+        masks = sorted(self.classmasks)
+        buf = [HEADER.pack(MAGIC, BINARY_VERSION, len(self.segments), \
+                len(self.features), len(masks), maskbytes)]
+        for seg in self.segments:
+            buf.append(struct.pack('<H', len(seg)) + seg + self.segdict[seg])
+        for feat in self.features:
+            buf.append(struct.pack('<H', len(feat)) + feat)
+        buf += [_mask2bytes(mask, maskbytes) for mask in masks]
+        offsets, items = [0], []
+        for mask in masks:
+            items += [iFeat << 1 | (featval == '-') \
+                    for iFeat, featval in self.classmasks[mask]]
+            offsets.append(len(items))
+        buf.append(struct.pack('<%dI' % len(offsets), *offsets))
+        buf.append(struct.pack('<%dH' % len(items), *items))
+        with open(outfile, 'wb') as fout:
+            fout.write(''.join(buf))
+
+    def loadbinary(self, infile, lazy = True):
+        """Loads segments, features and natural classes written by
+        savebinary, replacing any already loaded. If lazy, the file is
+        memory-mapped and the classes are only decoded as they are looked
+        up (see ClassTable); otherwise they are all read into a dict."""
+        with open(infile, 'rb') as fin:
+            if lazy: data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+            else: data = fin.read()
+        magic, version, nsegs, nfeats, nclasses, maskbytes = \
+                HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError, "%s is not a natural class file" %infile
+        if version != BINARY_VERSION:
+            raise ValueError, "%s has unsupported version %d" \
+                    %(infile, version)
+        offset = HEADER.size
+        segments = []
+        for i in xrange(nsegs):
+            (length,) = struct.unpack_from('<H', data, offset)
+            offset += 2
+            segments.append((data[offset:offset+length], \
+                    data[offset+length:offset+length+nfeats]))
+            offset += length+nfeats
+        self.__init__()
+        for i in xrange(nfeats):
+            (length,) = struct.unpack_from('<H', data, offset)
+            self._featindex[data[offset+2:offset+2+length]] = i
+            self.features.append(data[offset+2:offset+2+length])
+            offset += 2+length
+        for seg, featvals in segments: self._addsegment(seg, featvals)
+        for key in self.featdict: self.featdict[key].sort()
+        table = ClassTable(data, offset, nclasses, maskbytes)
+        if lazy: self.classmasks = table
+        else: self.classmasks = dict(table.items())
 
     def getclass(self, featspec):
         'Return the segs that match a featural specification.'
-        cur = self.segments
-        for item in featspec: cur = self.intersect(cur, \
-                self.featdict.get((self.features[item[0]],item[1]),[]))
-        return(sorted(cur))
-    
+        return(list(self.mask2segs(self.getmask(featspec))))
+
+    def getmask(self, featspec):
+        'Return the bitmask of the segs that match a featural specification.'
+        cur = self.allmask
+        for item in featspec:
+            cur &= self.featmasks.get((self.features[item[0]],item[1]),0)
+        return(cur)
+
+    def featvalmasks(self):
+        """Every (feature index, value) pair with a non-empty extension,
+        along with the bitmask of that extension, in featspec order."""
+        if self._featvals is None:
+            self._featvals = [(iFeat, featval, \
+                    self.featmasks[(feat,featval)]) \
+                    for featval in '+-' \
+                    for iFeat, feat in enumerate(self.features) \
+                    if self.featmasks.get((feat,featval),0)]
+        return(self._featvals)
+
+    def enclosingmask(self, mask):
+        """Bitmask of the smallest natural class containing every seg in
+        mask: the conjunction of every feature value they all share."""
+        cur = self.allmask
+        for iFeat, featval, featmask in self.featvalmasks():
+            if not mask & ~featmask: cur &= featmask
+        return(cur)
+
+    def enclosingclass(self, segList):
+        'Return the segs of the smallest natural class containing segList.'
+        mask = self.enclosingmask(self.segs2mask(segList))
+        return(list(self.mask2segs(mask)))
+
+    def mindescriptions(self, segList, maxsolutions = None):
+        """Finds the shortest featspecs of the smallest natural class
+        containing segList (segList itself, if it is a natural class),
+        without needing the natural classes to have been enumerated.
+
+        Every feature value shared by the whole class is a candidate, which
+        rules out the segments outside the class that lack it; a featspec
+        picks out the class iff its values together rule out every segment
+        outside it. The shortest such featspecs are found by iterative
+        deepening over the candidates with branch and bound (see
+        _searchcovers). Returns at most maxsolutions featspecs, if given,
+        each sorted by feature index. Raises ValueError for an empty
+        segList or an unknown segment."""
+        try: mask = self.segs2mask(segList)
+        except KeyError, seg: raise ValueError, "Unknown segment %s" %seg
+        if not mask: raise ValueError, "Empty segment list"
+        target = self.enclosingmask(mask)
+        outside = self.allmask & ~target
+        if not outside: return([[]])
+        candidates = [((iFeat, featval), outside & ~featmask) \
+                for iFeat, featval, featmask in self.featvalmasks() \
+                if not target & ~featmask and outside & ~featmask]
+        solutions = []
+        for depth in xrange(1, len(candidates)+1):
+            self._searchcovers(outside, candidates, depth, [], solutions, \
+                    maxsolutions)
+            if solutions: break
+        return(sorted(solutions))
+
+    def _searchcovers(self, remaining, candidates, depth, chosen, solutions,
+                      maxsolutions):
+        """Depth-limited search for sets of exactly depth candidates whose
+        masks cover remaining, appending each as a featspec to solutions.
+        Branches on the lowest remaining segment; in the branch for each
+        candidate that covers it, the candidates tried before it are
+        dropped, so every set is found once. A branch is pruned when even
+        the candidate covering the most remaining segments could not
+        finish within depth."""
+        if maxsolutions is not None and len(solutions) >= maxsolutions: return
+        if not remaining:
+            solutions.append(sorted(chosen))
+            return
+        left = depth - len(chosen)
+        if not left: return
+        best = max([bin(remaining & cover).count('1') \
+                for featvalue, cover in candidates] or [0])
+        if not best or best*left < bin(remaining).count('1'): return
+        segbit = remaining & -remaining
+        for k, (featvalue, cover) in enumerate(candidates):
+            if not cover & segbit: continue
+            rest = remaining & ~cover
+            self._searchcovers(rest, [(f, c) for i, (f, c) in \
+                    enumerate(candidates) if i != k and c & rest and \
+                    not (i < k and c & segbit)], depth, chosen+[featvalue], \
+                    solutions, maxsolutions)
+            if maxsolutions is not None and len(solutions) >= maxsolutions:
+                return
+
+    def segList2minFeatureStr(self, segList):
+        """A shortest feature string for a natural class (the first one
+        mindescriptions finds). Unlike segList2featureStr, this doesn't
+        need the natural classes to have been enumerated."""
+        try: mask = self.segs2mask(segList)
+        except KeyError: mask = 0
+        if not mask or self.enclosingmask(mask) != mask:
+            raise ValueError, "Non-existent natural class %s" %str(segList)
+        return(self.featspec2str(self.mindescriptions(segList, 1)[0]))
+
     def intersect(self, dict1, dict2):
         'Get keys that are in both dict1 and dict2'
         intersection = {}
@@ -178,13 +666,96 @@ class FeatureSet:
             if key in dict2: intersection[key] = 1
         return(intersection)
 
+    def _indexclass(self, mask):
+        'Adds a class to the segment -> classes index.'
+        rest = mask
+        while rest:
+            segbit = rest & -rest
+            self._segclassmasks[segbit.bit_length()-1].append(mask)
+            rest ^= segbit
+
+    def _segclassindex(self):
+        'The segment -> classes index, built now if the classes changed.'
+        if self._segclassmasks is None:
+            self._segclassmasks = [[] for seg in self.segments]
+            for mask in self.classmasks: self._indexclass(mask)
+        return(self._segclassmasks)
+
+    def segclassmasks(self, seg):
+        'Get the masks of all natural classes to which seg belongs'
+        try: return(list(self._segclassindex()[self._segindex[seg]]))
+        except KeyError: return([])
+
     def segclasses(self, seg):
         'Get all natural classes to which seg belongs'
-        classes = {}
-        for natclass in self.natclasses:
-            if seg in natclass: classes[natclass] = 1
-        return(classes)
-    
+        if seg not in self._segclasskeys:
+            self._segclasskeys[seg] = [self._classkey(mask) \
+                    for mask in self.segclassmasks(seg)]
+        return(dict.fromkeys(self._segclasskeys[seg], 1))
+
+    def seqclasses(self, segList):
+        """Get the natural classes to which each seg in a sequence belongs,
+        as a list with one segclasses dict per seg. Each distinct seg is
+        only looked up once."""
+        return([self.segclasses(seg) for seg in segList])
+
+    def segids(self, segList):
+        """Integer ids (indices into self.segments) of a list of segs.
+        Unknown segments raise KeyError."""
+        return(array.array('i', [self._segindex[seg] for seg in segList]))
+
+    def classorder(self):
+        """The natural class masks in ascending order. Bit j of a class
+        membership bitmask (see segclassbits) stands for the j-th class."""
+        if self._classorder is None:
+            self._classorder = sorted(self.classmasks)
+        return(self._classorder)
+
+    def segclassbits(self):
+        """For each segment id, a bitmask over classorder() of the natural
+        classes containing that segment."""
+        if self._segclassbits is None:
+            classpos = dict([(mask, j) for j, mask in \
+                    enumerate(self.classorder())])
+            self._segclassbits = [sum([1 << classpos[mask] \
+                    for mask in masks]) for masks in self._segclassindex()]
+        return(self._segclassbits)
+
+    def featrows(self):
+        """For each segment id, its feature values from self.segdict as an
+        array of FEATVALS, in feature order."""
+        if self._featrows is None:
+            self._featrows = [array.array('b', \
+                    [FEATVALS[featval] for featval in self.segdict[seg]]) \
+                    for seg in self.segments]
+        return(self._featrows)
+
+    def annotate(self, corpusfile, annotation = 'ids'):
+        """Streams a segmented corpus file (see readCorpus), yielding a
+        (segList, value) pair per word, where value depends on annotation:
+            'ids': the segment ids of the word (see segids)
+            'features': the word's segment x feature matrix, as a flat
+                row-major array of FEATVALS with len(self.features) columns
+            'classes': a list with the natural class membership bitmask of
+                each segment (see segclassbits)
+        Only one word is held in memory at a time. Unknown segments raise
+        ValueError."""
+        if annotation == 'ids': table = None
+        elif annotation == 'features': table = self.featrows()
+        elif annotation == 'classes': table = self.segclassbits()
+        else: raise ValueError, "Invalid annotation '%s'" %annotation
+        for lineno, segList in enumerate(readCorpus(corpusfile)):
+            try: ids = self.segids(segList)
+            except KeyError, seg:
+                raise ValueError, "Unknown segment %s in word %d of %s" \
+                        %(seg, lineno+1, corpusfile)
+            if annotation == 'ids': value = ids
+            elif annotation == 'features':
+                value = array.array('b')
+                for segid in ids: value.extend(table[segid])
+            else: value = [table[segid] for segid in ids]
+            yield segList, value
+
     def getNatClass2FeatureStrDict(self):
         return(dict([(segTuple,self.featspec2str(self.natclasses[segTuple])) \
                 for segTuple in self.natclasses]))
@@ -194,18 +765,45 @@ class FeatureSet:
                 for segTuple in self.natclasses]))
     
     def REinterpret(self, featREstr):
-        ''' pretty sure this function doesn't belong here '''
-        featRE = re.compile('\[[^\]]*\]')
-        features = featRE.finditer(featREstr)
-        lastChar, outBuf = 0, []
-        for match in features:
+        """Translates a feature regex, in which bracketed feature strings
+        stand for natural classes, into a plain regex over segments. Each
+        [feature string] becomes a group alternating the segments of its
+        class, longest first so that multi-character segments are not
+        shadowed by their prefixes; a class with no segments never
+        matches."""
+        outBuf, lastChar = [], 0
+        for match in FEATURE_RE.finditer(featREstr):
             ## first, add all regular text since last match point
             outBuf.append(featREstr[lastChar:match.start()])
             ## next, calculate the segments for the feature string
             segList = self.featureStr2segList(match.group()[1:-1])
+            segList.sort(key=lambda seg: (-len(seg), seg))
             ## plug those puppies in 'in place of' the feature string
-            outBuf.append('('+'|'.join(segList)+')')
+            if segList:
+                outBuf.append('('+'|'.join(map(re.escape, segList))+')')
+            else: outBuf.append('(?!)')
             ## and advance the index from the old string
             lastChar = match.end()
-        if lastChar < len(featREstr): outBuf.append(featREstr[lastChar:])
+        outBuf.append(featREstr[lastChar:])
         return(''.join(outBuf))
+
+    def REcompile(self, featREstr, flags = 0):
+        """Compiled pattern for a feature regex (see REinterpret). The most
+        recently used RE_CACHE_SIZE patterns are cached, so applying the
+        same rule patterns over and over only translates them once."""
+        key = (featREstr, flags)
+        try: pattern = self._recache.pop(key)
+        except KeyError:
+            pattern = re.compile(self.REinterpret(featREstr), flags)
+            if len(self._recache) >= RE_CACHE_SIZE:
+                self._recache.popitem(last=False)
+        self._recache[key] = pattern
+        return(pattern)
+
+    def REmatchWords(self, featREstr, words, search = True, flags = 0):
+        """Applies a feature regex to every word in a list. Returns a list
+        with the match object (or None) for each word, from pattern.search
+        or, if search is False, pattern.match."""
+        pattern = self.REcompile(featREstr, flags)
+        if search: return(map(pattern.search, words))
+        return(map(pattern.match, words))
@@ -1,3 +1,11 @@
+import importlib.util
+
+# Poset and Featurizer choose a matrix engine per instance. When no engine is
+# requested, numpy is used for matrices with at least this many rows (if it
+# is installed) and PackedBoolArray is used otherwise, so that small inputs
+# don't pay the cost of importing numpy.
+NUMPY_MIN_SIZE = 256
+
 class SimpleBoolArray():
     """
     This is a simple and very limited class representing a boolean array.
@@ -5,10 +13,11 @@ class SimpleBoolArray():
     the syntax of numpy arrays. It only implements the subset of functionality
     necessary for this program, so I don't recommend using it elsewhere.
 
-    This is SIGNIFICANTLY slower than the numpy implementation. If performance
-    is important to you, you can set the USE_NUMPY variable at the top of
-    this file to True to use a numpy implementation instead, which will of 
-    course require having numpy installed.
+    This is SIGNIFICANTLY slower than the numpy implementation and than
+    PackedBoolArray below, which is what Poset and Featurizer use by default.
+    If performance is important to you, you can request the 'numpy' engine
+    (see get_engine below) to use a numpy implementation instead, which will
+    of course require having numpy installed.
     """
     def __init__(self, shape, data):
         self.shape = shape
@@ -20,6 +29,16 @@ class SimpleBoolArray():
             shape, [[False for i in range(shape[0])] for j in range(shape[1])]
         )
 
+    @classmethod
+    def from_rows(self, rows, shape):
+        """
+        Builds an array from a list of ints, where bit j of rows[i] is the
+        value at [i, j].
+        """
+        return SimpleBoolArray(
+            shape, [[bool(row >> j & 1) for j in range(shape[1])] for row in rows]
+        )
+
     @classmethod
     def dot(self, m1, m2):
         """
@@ -91,3 +110,173 @@ class SimpleBoolArray():
         shape_str = 'Matrix{0}'.format(self.shape)
         dat_str = '\n\t'.join(str(row) for row in self.data)
         return('{0}[\n\t{1}]'.format(shape_str,dat_str))
+
+
+class PackedBoolArray():
+    """
+    A boolean array that packs each row into a single Python int, where
+    bit j of row i holds the value at [i, j]. It has the same interface
+    as SimpleBoolArray, but the whole-matrix operations work a row at a
+    time using bitwise operators, which is much faster:
+
+        elementwise AND: one & per row
+        NOT:             one ^ against a mask of all columns per row
+        dot:             row i of the product is the OR of the rows of m2
+                         selected by the set bits of row i of m1
+
+    This is the default array implementation for small inputs, and whenever
+    numpy is not installed.
+    """
+    def __init__(self, shape, rows):
+        self.shape = shape
+        self.rows = rows
+
+    @classmethod
+    def zeros(self, shape, dtype=None):
+        return PackedBoolArray(shape, [0] * shape[0])
+
+    @classmethod
+    def from_rows(self, rows, shape):
+        """
+        Builds an array from a list of ints, where bit j of rows[i] is the
+        value at [i, j].
+        """
+        return PackedBoolArray(shape, list(rows))
+
+    @classmethod
+    def dot(self, m1, m2):
+        """
+        Gets the boolean matrix product.
+        """
+        if m1.shape[1] != m2.shape[0]:
+            raise ValueError("m1.cols != m2.rows, dot is not defined")
+        new_rows = []
+        for row in m1.rows:
+            entry = 0
+            while row:
+                low = row & -row
+                entry |= m2.rows[low.bit_length() - 1]
+                row ^= low
+            new_rows.append(entry)
+        return PackedBoolArray((m1.shape[0], m2.shape[1]), new_rows)
+
+    def _indices(self, idx, size):
+        if type(idx) == slice:
+            return range(*idx.indices(size))
+        return None
+
+    def __getitem__(self, key):
+        row_idx, col_idx = key
+        rows = self._indices(row_idx, self.shape[0])
+        cols = self._indices(col_idx, self.shape[1])
+
+        if rows is None and cols is None:
+            return bool(self.rows[row_idx] >> col_idx & 1)
+        if rows is None:
+            row = self.rows[row_idx]
+            return [bool(row >> j & 1) for j in cols]
+        if cols is None:
+            return [bool(self.rows[i] >> col_idx & 1) for i in rows]
+        return [bool(self.rows[i] >> j & 1) for i in rows for j in cols]
+
+    def __setitem__(self, key, value):
+        i, j = key
+        if value:
+            self.rows[i] |= 1 << j
+        else:
+            self.rows[i] &= ~(1 << j)
+
+    def __mul__(self, m):
+        """
+        Does element-wise multiplcation
+        """
+        if self.shape != m.shape:
+            raise ValueError("Matrices must be the same shape for multiplication")
+        return PackedBoolArray(
+            self.shape, [r1 & r2 for r1, r2 in zip(self.rows, m.rows)]
+        )
+
+    def __invert__(self):
+        full = (1 << self.shape[1]) - 1
+        return PackedBoolArray(self.shape, [row ^ full for row in self.rows])
+
+    def __str__(self):
+        shape_str = 'Matrix{0}'.format(self.shape)
+        dat_str = '\n\t'.join(
+            str([bool(row >> j & 1) for j in range(self.shape[1])])
+            for row in self.rows
+        )
+        return('{0}[\n\t{1}]'.format(shape_str,dat_str))
+
+
+class NumpyBoolArray():
+    """
+    Exposes numpy through the same zeros/dot interface as the classes above.
+    The arrays themselves are plain numpy bool arrays. dot casts to float32 so
+    that the product goes through the BLAS matrix multiply; this is exact for
+    our purposes, since all terms are non-negative and we only test whether
+    each entry of the product is non-zero.
+    """
+    @classmethod
+    def zeros(self, shape, dtype=None):
+        return np.zeros(shape, dtype=bool)
+
+    @classmethod
+    def from_rows(self, rows, shape):
+        """
+        Builds an array from a list of ints, where bit j of rows[i] is the
+        value at [i, j].
+        """
+        nbytes = (shape[1] + 7) // 8
+        packed = np.frombuffer(
+            b''.join(row.to_bytes(nbytes, 'big') for row in rows),
+            dtype=np.uint8
+        ).reshape(shape[0], nbytes)
+        # unpackbits puts the most significant bit first, so bit j of a row
+        # ends up in column 8 * nbytes - 1 - j (unpackbits' bitorder argument
+        # would avoid the reversal, but needs numpy 1.17)
+        bits = np.unpackbits(packed, axis=1)[:, ::-1]
+        return bits[:, :shape[1]].astype(bool)
+
+    @classmethod
+    def dot(self, m1, m2):
+        return np.matmul(m1.astype(np.float32), m2.astype(np.float32)) > 0
+
+
+def _load_numpy():
+    global np
+    import numpy as np
+    return NumpyBoolArray
+
+# Maps engine names to functions returning a class with the zeros/dot
+# interface. Engines are only loaded when they are first requested.
+ENGINES = {
+    'simple': lambda: SimpleBoolArray,
+    'packed': lambda: PackedBoolArray,
+    'numpy': _load_numpy,
+}
+
+def register_engine(name, loader):
+    """
+    Makes a new matrix engine available to get_engine. loader is called with
+    no arguments and must return a class providing zeros and dot.
+    """
+    ENGINES[name] = loader
+
+def numpy_available():
+    """Checks whether numpy is installed without importing it"""
+    return importlib.util.find_spec('numpy') is not None
+
+def get_engine(name=None, size=0):
+    """
+    Gets the matrix engine with the given name. If name is None, picks one
+    based on the size of the matrices it will be used for.
+    """
+    if name is None:
+        if size >= NUMPY_MIN_SIZE and numpy_available():
+            name = 'numpy'
+        else:
+            name = 'packed'
+    if name not in ENGINES:
+        raise ValueError("Unknown matrix engine '{}'".format(name))
+    return ENGINES[name]()
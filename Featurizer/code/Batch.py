@@ -0,0 +1,206 @@
+import Array
+import argparse
+import sys
+import time
+import traceback
+
+from Featurizer import Featurizer, FEATURIZATION_MAP
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import listdir, makedirs, path
+
+DEFAULT_CSV_DIR = "../csv_output"
+DEFAULT_POSET_DIR = "../poset_output"
+DEFAULT_FEATS_DIR = "../feats_output"
+
+def find_inputs(source):
+    '''
+        Gets the list of input class files to featurize.
+
+        Input:
+            source: Either a directory, in which case every .txt file in it is
+                used, or a manifest file listing one input file per line.
+                Relative paths in a manifest are relative to the manifest's
+                directory. Blank lines and lines starting with # are ignored.
+
+        Returns:
+            A sorted list of paths
+    '''
+    if path.isdir(source):
+        return sorted(
+            path.join(source, f) for f in listdir(source) if f.endswith('.txt')
+        )
+    inputs = []
+    with open(source, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                inputs.append(path.join(path.dirname(source), line))
+    return inputs
+
+def run_job(job):
+    '''
+        Featurizes a single input file under each of a list of
+        specifications, and writes the CSV and both DOT files for each. The
+        intersectional closure of the input classes is only calculated for
+        the first specification; the others share it (see
+        Featurizer.with_specification). Any exception is caught and reported
+        in the result for the specification it happened in, so that one bad
+        inventory doesn't stop the rest of a batch.
+
+        Input:
+            job: A tuple (<input file>, <list of featurization names>,
+                <csv directory>, <poset graph directory>,
+                <feature graph directory>, <engine>)
+
+        Returns:
+            A list with a dict for each featurization, describing it, its
+            outcome, and how long it took. The time for the first successful
+            featurization includes reading the file and calculating the
+            closure.
+    '''
+    filename, featurizations, csv_dir, poset_dir, feats_dir, engine = job
+    results = []
+    base_featurizer = None
+    for featurization in featurizations:
+        result = {
+            'input_file': filename,
+            'featurization': featurization,
+            'ok': False,
+            'error': None,
+            'classes': None,
+            'features': None,
+        }
+        start = time.perf_counter()
+        try:
+            specification = FEATURIZATION_MAP[featurization]
+            if base_featurizer is None:
+                featurizer = Featurizer.from_file(
+                    filename, specification, engine=engine
+                )
+                base_featurizer = featurizer
+            else:
+                featurizer = base_featurizer.with_specification(specification)
+            featurizer.get_features_from_classes()
+            outname = '{}_{}'.format(featurizer.rootname, featurization)
+            featurizer.features_to_csv(path.join(csv_dir, outname + '.csv'))
+            featurizer.graph_poset(path.join(poset_dir, outname + '.gv'))
+            featurizer.graph_feats(path.join(feats_dir, outname + '.gv'))
+            result['ok'] = True
+            result['classes'] = len(featurizer.poset.classes)
+            result['features'] = featurizer.feature_num - 1
+        except Exception:
+            result['error'] = traceback.format_exc()
+        result['seconds'] = time.perf_counter() - start
+        results.append(result)
+    return results
+
+def run_jobs(jobs, processes=None):
+    '''
+        Runs jobs (see run_job) on a pool of processes.
+
+        Returns:
+            A generator of the results of every job, in the order in which
+            the jobs finish
+    '''
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(run_job, job) for job in jobs]
+        for future in as_completed(futures):
+            for result in future.result():
+                yield result
+
+def run_batch(inputs, featurizations, csv_dir=DEFAULT_CSV_DIR,
+              poset_dir=DEFAULT_POSET_DIR, feats_dir=DEFAULT_FEATS_DIR,
+              processes=None, engine=None):
+    '''
+        Featurizes every input file under every featurization type, spreading
+        the input files across a pool of processes. All the featurizations
+        of a file are done by the same process, so that they can share its
+        intersectional closure.
+
+        Input:
+            inputs: A list of input class files
+            featurizations: A list of featurization names (keys of
+                FEATURIZATION_MAP)
+            csv_dir, poset_dir, feats_dir: Where to save the outputs, which
+                are created if they don't exist. Files are named
+                <input file name>_<featurization>.csv/.gv
+            processes: The number of worker processes (default: one per CPU)
+            engine: The matrix engine to use (see Array.get_engine)
+
+        Returns:
+            A generator of results, one per input file and featurization
+            (see run_job). The results for each file come together, in the
+            order in which the files finish. Invalid featurization names
+            raise a ValueError straight away, before anything is run.
+    '''
+    for featurization in featurizations:
+        if featurization not in FEATURIZATION_MAP:
+            raise ValueError(
+                "Invalid featural specification '{}'".format(featurization)
+            )
+    for directory in (csv_dir, poset_dir, feats_dir):
+        makedirs(directory, exist_ok=True)
+    jobs = [
+        (filename, featurizations, csv_dir, poset_dir, feats_dir, engine)
+        for filename in inputs
+    ]
+    return run_jobs(jobs, processes)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description = "Featurize a collection of input class files under one "
+                      "or more featurization types in parallel."
+    )
+    parser.add_argument(
+        'source', type=str,
+        help='A directory of input class files (*.txt), or a manifest file '
+             'listing one input class file per line.'
+    )
+    parser.add_argument(
+        '--featurizations', type=str, nargs='+',
+        default=list(FEATURIZATION_MAP), choices=sorted(FEATURIZATION_MAP),
+        help="The featurization types to use. Each must be one of "
+             "'privative', 'complementary', 'inferential_complementary', or "
+             "'full'. Default: all of them."
+    )
+    parser.add_argument(
+        '--processes', type=int, default=None,
+        help='The number of worker processes. Default: one per CPU.'
+    )
+    parser.add_argument(
+        '--engine', type=str, default=None, choices=sorted(Array.ENGINES),
+        help='The matrix engine to use (see Featurizer.py).'
+    )
+    parser.add_argument(
+        '--csv_dir', type=str, default=DEFAULT_CSV_DIR,
+        help='The directory to save featurization CSVs in.'
+    )
+    parser.add_argument(
+        '--poset_dir', type=str, default=DEFAULT_POSET_DIR,
+        help='The directory to save poset graphs in.'
+    )
+    parser.add_argument(
+        '--feats_dir', type=str, default=DEFAULT_FEATS_DIR,
+        help='The directory to save featurization graphs in.'
+    )
+    args = parser.parse_args()
+
+    failures = 0
+    results = run_batch(
+        find_inputs(args.source), args.featurizations, args.csv_dir,
+        args.poset_dir, args.feats_dir, args.processes, args.engine
+    )
+    for result in results:
+        if result['ok']:
+            print("ok\t{:.3f}s\t{}\t{}\t{} classes, {} features".format(
+                result['seconds'], result['input_file'],
+                result['featurization'], result['classes'], result['features']
+            ))
+        else:
+            failures += 1
+            print("FAILED\t{:.3f}s\t{}\t{}".format(
+                result['seconds'], result['input_file'],
+                result['featurization']
+            ))
+            print(result['error'], file=sys.stderr)
+    sys.exit(1 if failures else 0)
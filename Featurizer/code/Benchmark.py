@@ -0,0 +1,459 @@
+import Array
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from Featurizer import Featurizer, FEATURIZATION_MAP
+from os import makedirs, path
+from Poset import Poset
+
+DEFAULT_REPORT_FILE = "../benchmark_output/report.json"
+# FeatureSet.py is Python 2 code, so FeatureSet.getclasses is timed in a
+# separate interpreter (see run_featureset)
+DEFAULT_PYTHON2 = "python2"
+FEATURESET_DIR = path.join(path.dirname(path.abspath(__file__)), '..', '..')
+REPORT_VERSION = 3
+
+# Times FeatureSet.getclasses on a feature file under Python 2 and prints its
+# results as JSON. Arguments: <FeatureSet.py directory> <file>
+# tracemalloc doesn't exist in Python 2, so its peak memory is the process's
+# maximum resident set size instead
+FEATURESET_SCRIPT = '''
+import json, resource, sys, time
+sys.path.insert(0, sys.argv[1])
+from FeatureSet import FeatureSet
+feature_set = FeatureSet()
+feature_set.readFeatures(sys.argv[2])
+start = time.time()
+feature_set.getclasses()
+seconds = time.time() - start
+print(json.dumps({
+    'seconds': seconds,
+    'closure_size': len(feature_set.classmasks),
+    'peak_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    'peak_measure': 'max_rss'
+}))
+'''
+
+def generate_inventory(num_segments, num_classes, depth, seed=0):
+    '''
+        Generates a synthetic class system.
+
+        The first classes form a tree: the alphabet is split into two random
+        halves, each of those is split in two, and so on, down to depth
+        levels (or until a class has a single segment). The rest are random
+        subsets of the alphabet which cut across the tree, and so create
+        intersections for the closure to find.
+
+        Input:
+            num_segments: The size of the alphabet
+            num_classes: The number of input classes
+            depth: The number of levels of nesting in the tree
+            seed: The seed for the random number generator, so that the same
+                arguments always produce the same system
+
+        Returns:
+            A tuple (<alphabet>, <input classes>): a set of segments and a
+            list of sets of segments, in the form taken by Featurizer
+    '''
+    rng = random.Random(seed)
+    alphabet = ['s{}'.format(i) for i in range(num_segments)]
+    classes = []
+    seen = {frozenset(alphabet)}
+
+    def add(c):
+        c = frozenset(c)
+        if c and c not in seen and len(classes) < num_classes:
+            seen.add(c)
+            classes.append(c)
+
+    level = [alphabet]
+    for i in range(depth):
+        next_level = []
+        for c in level:
+            if len(c) < 2:
+                continue
+            c = list(c)
+            rng.shuffle(c)
+            cut = rng.randint(1, len(c) - 1)
+            for half in (c[:cut], c[cut:]):
+                add(half)
+                next_level.append(half)
+        level = next_level
+
+    attempts = 0
+    while len(classes) < num_classes:
+        attempts += 1
+        if attempts > 100 * num_classes:
+            raise ValueError(
+                "Can't generate {} distinct classes over {} segments".format(
+                    num_classes, num_segments
+                )
+            )
+        size = rng.randint(1, max(1, num_segments // 2))
+        add(rng.sample(alphabet, size))
+
+    return set(alphabet), [set(c) for c in classes]
+
+def write_inventory(filename, alphabet, classes):
+    '''Saves a class system in the format read by Featurizer.from_file'''
+    with open(filename, 'w') as f:
+        f.write(' '.join(sorted(alphabet)) + '\n')
+        for c in classes:
+            f.write(' '.join(sorted(c)) + '\n')
+
+def write_feature_file(filename, alphabet, classes):
+    '''
+        Saves a class system as a FeatureSet feature file, with one privative
+        feature per input class. The natural classes of the resulting
+        FeatureSet are the intersectional closure of the input classes.
+    '''
+    with open(filename, 'w') as f:
+        f.write('\t' + '\t'.join(
+            'F{}'.format(i) for i in range(len(classes))
+        ) + '\n')
+        for segment in sorted(alphabet):
+            f.write(segment + '\t' + '\t'.join(
+                '+' if segment in c else '0' for c in classes
+            ) + '\n')
+
+def measure(function, repeat=1, memory=True):
+    '''
+        Runs a function and measures it.
+
+        Input:
+            function: A function of no arguments
+            repeat: The number of timed runs. The fastest is reported.
+            memory: Whether to do an extra run with tracemalloc to find the
+                peak memory allocated. It's separate from the timed runs,
+                since tracing slows everything down.
+
+        Returns:
+            A tuple (<result of the last run>, <seconds>, <peak bytes or None>)
+    '''
+    seconds = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        if seconds is None or elapsed < seconds:
+            seconds = elapsed
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, seconds, peak
+
+def run_featurizer(alphabet, classes, featurization, repeat=1, memory=True):
+    '''
+        Featurizes a class system from scratch (closure included) and
+        measures it. The featurization doesn't build any matrices, so it's
+        the same under every engine (see run_matrices).
+
+        Returns:
+            A dict of results for the report
+    '''
+    def featurize():
+        featurizer = Featurizer(
+            classes, alphabet, FEATURIZATION_MAP[featurization]
+        )
+        featurizer.get_features_from_classes()
+        return featurizer
+
+    featurizer, seconds, peak = measure(featurize, repeat, memory)
+    return {
+        'seconds': seconds,
+        'peak_bytes': peak,
+        'peak_measure': 'tracemalloc' if peak is not None else None,
+        'closure_size': len(featurizer.base_poset.classes),
+        'classes': len(featurizer.poset.classes),
+        'features': featurizer.feature_num - 1,
+    }
+
+def run_matrices(alphabet, classes, engine, repeat=1, memory=True):
+    '''
+        Calculates the subset and daughter matrices of the intersectional
+        closure of a class system with a matrix engine, and measures it.
+
+        Returns:
+            A dict of results for the report
+    '''
+    poset = Poset(alphabet, classes, engine=engine)
+    poset.get_intersectional_closure()
+
+    def calculate():
+        poset.calculate_subset_matrix()
+        poset.calculate_daughter_matrix()
+        return poset
+
+    poset, seconds, peak = measure(calculate, repeat, memory)
+    return {
+        'seconds': seconds,
+        'peak_bytes': peak,
+        'peak_measure': 'tracemalloc' if peak is not None else None,
+        'closure_size': len(poset.classes),
+    }
+
+def run_featureset(alphabet, classes, python2=DEFAULT_PYTHON2):
+    '''
+        Times FeatureSet.getclasses on the privative feature file for a class
+        system (see write_feature_file), in a python2 subprocess.
+
+        Returns:
+            A dict of results for the report
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = path.join(tmp_dir, 'features.txt')
+        write_feature_file(filename, alphabet, classes)
+        output = subprocess.run(
+            [python2, '-c', FEATURESET_SCRIPT, FEATURESET_DIR, filename],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, check=True
+        ).stdout
+    return json.loads(output)
+
+def run_benchmarks(sizes, featurizations=None, engines=None, seed=0, repeat=1,
+                   memory=True, python2=DEFAULT_PYTHON2, verbose=False):
+    '''
+        Runs every featurization type, the subset and daughter matrix
+        calculations under every engine, and FeatureSet.getclasses, on a
+        synthetic class system of each size.
+
+        Input:
+            sizes: A list of tuples (<segments>, <classes>, <depth>) (see
+                generate_inventory)
+            featurizations: The featurization names to run (default: all)
+            engines: The matrix engines to run (default: all available)
+            seed, repeat, memory: As for generate_inventory and measure
+            python2: The Python 2 interpreter to run FeatureSet in, or None
+                to skip it
+            verbose: Whether to print each result as it is measured
+
+        Returns:
+            A list of result dicts, one per run. A run that fails has an
+            'error' instead of measurements.
+    '''
+    if featurizations is None:
+        featurizations = sorted(FEATURIZATION_MAP)
+    if engines is None:
+        engines = sorted(
+            name for name in Array.ENGINES
+            if name != 'numpy' or Array.numpy_available()
+        )
+    results = []
+    for num_segments, num_classes, depth in sizes:
+        alphabet, classes = generate_inventory(
+            num_segments, num_classes, depth, seed
+        )
+        runs = [
+            ('featurizer', featurization, None,
+             lambda f=featurization: run_featurizer(
+                 alphabet, classes, f, repeat, memory
+             ))
+            for featurization in featurizations
+        ] + [
+            ('matrices', None, engine,
+             lambda e=engine: run_matrices(
+                 alphabet, classes, e, repeat, memory
+             ))
+            for engine in engines
+        ]
+        if python2:
+            runs.append((
+                'featureset', None, None,
+                lambda: run_featureset(alphabet, classes, python2)
+            ))
+        for target, featurization, engine, run in runs:
+            result = {
+                'target': target,
+                'segments': num_segments,
+                'input_classes': num_classes,
+                'depth': depth,
+                'featurization': featurization,
+                'engine': engine,
+            }
+            try:
+                result.update(run())
+            except Exception as e:
+                result['error'] = '{}: {}'.format(type(e).__name__, e)
+            if verbose:
+                print(format_result(result))
+            results.append(result)
+    return results
+
+def result_key(result):
+    '''Identifies the run a result is for, across reports'''
+    return (
+        result['target'], result['segments'], result['input_classes'],
+        result['depth'], result['featurization'] or '', result['engine'] or ''
+    )
+
+def format_result(result):
+    name = '{}/{}/{}'.format(
+        result['target'], result['featurization'] or '-',
+        result['engine'] or '-'
+    )
+    size = '{}x{}d{}'.format(
+        result['segments'], result['input_classes'], result['depth']
+    )
+    if 'error' in result:
+        return '{:<45} {:<12} ERROR {}'.format(name, size, result['error'])
+    return '{:<45} {:<12} {:>10.4f}s'.format(name, size, result['seconds'])
+
+def make_report(results, parameters):
+    '''Wraps a list of results with what's needed to compare reports'''
+    return {
+        'version': REPORT_VERSION,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'results': sorted(results, key=result_key),
+    }
+
+def git_commit():
+    '''The commit the code is at, if it's in a git checkout'''
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=path.dirname(path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_reports(old, new):
+    '''
+        Lines comparing the times of the runs two reports have in common,
+        as <new seconds> / <old seconds>.
+    '''
+    old_results = {
+        result_key(r): r for r in old['results'] if 'error' not in r
+    }
+    lines = []
+    for result in new['results']:
+        previous = old_results.get(result_key(result))
+        if previous is None or 'error' in result:
+            continue
+        lines.append('{} {:>8.2f}x'.format(
+            format_result(result),
+            result['seconds'] / max(previous['seconds'], 1e-9)
+        ))
+    return lines
+
+def parse_size(s):
+    '''Parses a size argument of the form <segments>x<classes>x<depth>'''
+    try:
+        num_segments, num_classes, depth = (int(n) for n in s.split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "Size '{}' is not of the form "
+            "<segments>x<classes>x<depth>".format(s)
+        )
+    return num_segments, num_classes, depth
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description = "Benchmark the featurization algorithms and "
+                      "FeatureSet.getclasses on synthetic class systems."
+    )
+    parser.add_argument(
+        '--sizes', type=parse_size, nargs='+',
+        default=[(12, 12, 2), (16, 16, 3), (24, 16, 3)],
+        help='The class systems to generate, each as '
+             '<segments>x<classes>x<depth>. Default: 12x12x2 16x16x3 24x16x3.'
+    )
+    parser.add_argument(
+        '--featurizations', type=str, nargs='+', default=None,
+        choices=sorted(FEATURIZATION_MAP),
+        help='The featurization types to run. Default: all of them.'
+    )
+    parser.add_argument(
+        '--engines', type=str, nargs='+', default=None,
+        choices=sorted(Array.ENGINES),
+        help='The matrix engines to calculate the subset and daughter '
+             'matrices with. Default: all available.'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='The seed for generating class systems.'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=1,
+        help='The number of timed runs of each benchmark; the fastest is '
+             'reported.'
+    )
+    parser.add_argument(
+        '--no_memory', action='store_true',
+        help="Don't measure peak memory, which takes an extra run of each "
+             "benchmark."
+    )
+    parser.add_argument(
+        '--python2', type=str, default=DEFAULT_PYTHON2,
+        help="The Python 2 interpreter to benchmark FeatureSet with, or '' "
+             "to skip it."
+    )
+    parser.add_argument(
+        '--report_file', type=str, default=DEFAULT_REPORT_FILE,
+        help="The path to save the JSON report in, or '-' to write it to "
+             "stdout."
+    )
+    parser.add_argument(
+        '--baseline', type=str, default=None,
+        help='A report from an earlier run to compare the times against.'
+    )
+    parser.add_argument(
+        '--inputs_dir', type=str, default=None,
+        help='A directory to also save the generated class systems in, as '
+             'input files for Featurizer.py.'
+    )
+    args = parser.parse_args()
+
+    if args.inputs_dir:
+        makedirs(args.inputs_dir, exist_ok=True)
+        for num_segments, num_classes, depth in args.sizes:
+            alphabet, classes = generate_inventory(
+                num_segments, num_classes, depth, args.seed
+            )
+            write_inventory(
+                path.join(args.inputs_dir, 'synthetic_{}x{}x{}.txt'.format(
+                    num_segments, num_classes, depth
+                )),
+                alphabet, classes
+            )
+
+    results = run_benchmarks(
+        args.sizes, args.featurizations, args.engines, args.seed,
+        args.repeat, not args.no_memory, args.python2 or None,
+        verbose=args.report_file != '-'
+    )
+    report = make_report(results, {
+        'sizes': args.sizes,
+        'seed': args.seed,
+        'repeat': args.repeat,
+    })
+    if args.report_file == '-':
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        print()
+    else:
+        makedirs(path.dirname(args.report_file) or '.', exist_ok=True)
+        with open(args.report_file, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        print('Compared to {}:'.format(baseline.get('commit')))
+        for line in compare_reports(baseline, report):
+            print(line)
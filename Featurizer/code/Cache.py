@@ -0,0 +1,266 @@
+import hashlib
+import os
+import struct
+import zlib
+
+from Poset import Poset
+
+DEFAULT_CACHE_DIR = "../cache"
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# The modules whose source determines a featurization (see code_version)
+CODE_FILES = ['Featurizer.py', 'Poset.py']
+
+# Cache files start with MAGIC, FORMAT_VERSION (uint16) and the 32-byte key
+# of the entry, followed by a zlib-compressed body (see encode). Bump
+# FORMAT_VERSION whenever the layout of the body changes.
+MAGIC = b'PHFZ'
+FORMAT_VERSION = 1
+FILE_EXTENSION = '.feat'
+
+def code_version():
+    '''
+        A hash of the source of the modules that determine a featurization,
+        so that cache entries are never reused after the algorithm changes.
+    '''
+    digest = hashlib.sha256()
+    for name in CODE_FILES:
+        with open(os.path.join(os.path.dirname(__file__), name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def write_string(buf, s):
+    data = s.encode('utf-8')
+    buf.append(struct.pack('<H', len(data)))
+    buf.append(data)
+
+def read_string(data, offset):
+    (length,) = struct.unpack_from('<H', data, offset)
+    offset += 2
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+def remove_entry(filename):
+    '''
+        Deletes a cache file. Another process sharing the directory may
+        already have deleted it, which is fine.
+    '''
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+class FeaturizationCache():
+    """
+    A persistent cache of featurizations, stored as one file per entry in a
+    directory. An entry is keyed by a hash of the alphabet, the input classes
+    (in order), the specification and the code version, and holds what's
+    needed to rebuild the featurized Featurizer without any calculation:
+
+        the segment table (every segment, sorted)
+        the next feature number
+        the classes in the final poset, in order, as bitmasks over the
+            segment table
+        the children of each class in the poset
+        the features of each segment
+
+    Each class bitmask takes a fixed number of bytes, and all counts and
+    indices are uint32s. When the directory grows beyond max_bytes, the
+    least recently used entries are deleted.
+    """
+    def __init__(self, directory=DEFAULT_CACHE_DIR,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = code_version()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, input_classes, alphabet, specification):
+        '''Gets the raw key for the featurization of the given inputs'''
+        digest = hashlib.sha256()
+        digest.update(self.version.encode('utf-8'))
+        digest.update(specification.name.encode('utf-8'))
+        for c in [alphabet] + list(input_classes):
+            digest.update(b'\x00')
+            digest.update('\x01'.join(sorted(c)).encode('utf-8'))
+        return digest.digest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key.hex() + FILE_EXTENSION)
+
+    def load(self, featurizer_class, input_classes, alphabet, specification,
+             **kwargs):
+        '''
+            Gets a featurized Featurizer for the given inputs from the cache.
+
+            Input:
+                featurizer_class: The Featurizer class to create
+                input_classes, alphabet, specification: As for Featurizer
+                kwargs: Any other Featurizer constructor arguments
+
+            Returns:
+                The Featurizer, or None if the cache has no entry for it
+        '''
+        key = self.key(input_classes, alphabet, specification)
+        filename = self.path(key)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        header = MAGIC + struct.pack('<H', FORMAT_VERSION) + key
+        if not data.startswith(header):
+            # Stale or corrupt entry
+            remove_entry(filename)
+            self.misses += 1
+            return None
+        try:
+            featurizer = self.decode(
+                zlib.decompress(data[len(header):]), featurizer_class,
+                input_classes, alphabet, specification, kwargs
+            )
+        except (zlib.error, struct.error, UnicodeDecodeError, ValueError):
+            # Truncated or corrupt body
+            remove_entry(filename)
+            self.misses += 1
+            return None
+        # Mark the entry as recently used
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            # Evicted by another process since it was read
+            self.misses += 1
+            return None
+        self.hits += 1
+        return featurizer
+
+    def store(self, featurizer):
+        '''Saves a featurized Featurizer in the cache'''
+        key = self.key(
+            featurizer.input_classes, featurizer.alphabet,
+            featurizer.specification
+        )
+        filename = self.path(key)
+        data = MAGIC + struct.pack('<H', FORMAT_VERSION) + key + \
+            zlib.compress(self.encode(featurizer))
+        # Write to a temporary file first so that readers never see a
+        # partially written entry
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filename, filename)
+        self.evict()
+
+    def evict(self):
+        '''Deletes the least recently used entries until under max_bytes'''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(FILE_EXTENSION):
+                filename = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(filename)
+                except FileNotFoundError:
+                    # Evicted by another process since listdir
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            remove_entry(filename)
+            total -= size
+
+    def encode(self, featurizer):
+        '''Gets the uncompressed body of the cache entry for a featurizer'''
+        poset = featurizer.poset
+        segments = sorted(
+            set(featurizer.segment_features) | set(poset.segment_bits)
+        )
+        segment_bits = {s: 1 << i for i, s in enumerate(segments)}
+        mask_bytes = (len(segments) + 7) // 8
+
+        buf = [struct.pack('<I', len(segments))]
+        for segment in segments:
+            write_string(buf, segment)
+        buf.append(struct.pack('<I', featurizer.feature_num))
+
+        buf.append(struct.pack('<II', len(poset.classes), mask_bytes))
+        for c in poset.classes:
+            mask = 0
+            for segment in c:
+                mask |= segment_bits[segment]
+            buf.append(mask.to_bytes(mask_bytes, 'little'))
+        for children in poset.child_indices:
+            buf.append(struct.pack(
+                '<I{}I'.format(len(children)), len(children), *children
+            ))
+
+        for segment in segments:
+            features = sorted(featurizer.segment_features[segment])
+            buf.append(struct.pack('<I', len(features)))
+            for number, value in features:
+                buf.append(struct.pack('<Ic', number, value.encode('ascii')))
+        return b''.join(buf)
+
+    def decode(self, data, featurizer_class, input_classes, alphabet,
+               specification, kwargs):
+        '''Rebuilds a featurized Featurizer from the body of a cache entry'''
+        (n_segments,) = struct.unpack_from('<I', data, 0)
+        offset = 4
+        segments = []
+        for i in range(n_segments):
+            segment, offset = read_string(data, offset)
+            segments.append(segment)
+        (feature_num,) = struct.unpack_from('<I', data, offset)
+        offset += 4
+
+        n_classes, mask_bytes = struct.unpack_from('<II', data, offset)
+        offset += 8
+        classes = []
+        for i in range(n_classes):
+            mask = int.from_bytes(data[offset:offset + mask_bytes], 'little')
+            offset += mask_bytes
+            classes.append(
+                {s for j, s in enumerate(segments) if mask >> j & 1}
+            )
+        child_indices = []
+        for i in range(n_classes):
+            (n_children,) = struct.unpack_from('<I', data, offset)
+            offset += 4
+            child_indices.append(list(struct.unpack_from(
+                '<{}I'.format(n_children), data, offset
+            )))
+            offset += 4 * n_children
+
+        segment_features = {}
+        for segment in segments:
+            (n_features,) = struct.unpack_from('<I', data, offset)
+            offset += 4
+            features = set()
+            for i in range(n_features):
+                number, value = struct.unpack_from('<Ic', data, offset)
+                offset += 5
+                features.add((number, value.decode('ascii')))
+            segment_features[segment] = features
+
+        poset = Poset(
+            alphabet, input_classes, engine=kwargs.get('engine'),
+            cover_relation=(classes, child_indices)
+        )
+        featurizer = featurizer_class(
+            input_classes, alphabet, specification, base_poset=poset, **kwargs
+        )
+        if specification.name in ('INFERENTIAL_COMPLEMENTARY', 'FULL'):
+            # The cached poset includes the complement classes, so it isn't
+            # the intersectional closure of the inputs
+            featurizer.base_poset = None
+        for segment, features in segment_features.items():
+            featurizer.set_segment_features({segment}, features)
+        featurizer.feature_num = feature_num
+        featurizer.calculate_class_features()
+        featurizer.featurized = True
+        featurizer.cache = self
+        return featurizer
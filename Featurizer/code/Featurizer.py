@@ -1,21 +1,13 @@
+import Array
 import argparse
+import sys
 
-from Poset import Poset
+from Poset import Poset, open_output
+from Stats import Stats, timed
 from collections import defaultdict, deque
 from enum import Enum
 from os import path
 
-# This code requires boolean matrix functionality, which numpy provides
-# set this value to True if you have numpy installed
-# otherwise, use our slower native Python implementation
-USE_NUMPY = False
-if USE_NUMPY:
-    import numpy as np
-    ARRAY = np
-else:
-    import Array
-    ARRAY = Array.SimpleBoolArray
-
 DEFAULT_ROOTNAME = "feature_output"
 
 class Specification(Enum):
@@ -34,7 +26,7 @@ FEATURIZATION_MAP = {
 class Featurizer():
     def __init__(self, input_classes, alphabet,
                  specification=Specification.COMPLEMENTARY, verbose=False,
-                 rootname=DEFAULT_ROOTNAME):
+                 rootname=DEFAULT_ROOTNAME, engine=None, base_poset=None):
         '''
             Default class constructor that must be given an alphabet and a set
             of input classes.
@@ -46,6 +38,12 @@ class Featurizer():
                     featurization to do
                 verbose: A bool indicating whether to print extra information
                     during the featurization
+                engine: The name of the matrix engine to use for boolean
+                    matrix calculations (see Array.get_engine). If None, one
+                    is chosen automatically based on the size of the poset.
+                base_poset: The intersectional closure of input_classes, if
+                    it has already been calculated (e.g. by another
+                    Featurizer for the same inputs). It isn't modified.
         '''
         if specification not in Specification:
             raise Exception("Invalid featural specification '{}'".format(specification))
@@ -55,11 +53,15 @@ class Featurizer():
         self.specification = specification
         self.verbose = verbose
         self.rootname = rootname
+        self.engine = engine
+        self.base_poset = base_poset
+        # A FeaturizationCache to save the featurization in, if any
+        self.cache = None
         self.reset()
 
     @classmethod
     def from_file(cls, filename, specification=Specification.COMPLEMENTARY,
-                  use_numpy=False, verbose=False):
+                  use_numpy=False, verbose=False, engine=None, cache=None):
         '''
             An alternative constructor that creates a Featurizer object based on
             the contents of a file. The file should have the following format
@@ -75,6 +77,12 @@ class Featurizer():
             Input:
                 filename: A string specifying where to find the input file.
                 specification: The type of featurization to do
+                use_numpy: Shorthand for engine='numpy'
+                engine: The name of the matrix engine to use
+                cache: A FeaturizationCache (see Cache.py). If it has an
+                    entry for the file's contents, the Featurizer is loaded
+                    from it already featurized; otherwise the featurization
+                    is saved to it once it has been calculated.
         '''
         with open(filename, 'r') as f:
             alphabet = set(next(f).rstrip().split(' '))
@@ -84,10 +92,21 @@ class Featurizer():
                 if c:
                     classes.append(c)
         rootname = path.splitext(path.split(filename)[1])[0]
-        return Featurizer(
+        if use_numpy:
+            engine = 'numpy'
+        if cache is not None:
+            featurizer = cache.load(
+                cls, classes, alphabet, specification, verbose=verbose,
+                rootname=rootname, engine=engine
+            )
+            if featurizer is not None:
+                return featurizer
+        featurizer = Featurizer(
             classes, alphabet, specification, verbose=verbose, 
-            rootname=rootname
+            rootname=rootname, engine=engine
         )
+        featurizer.cache = cache
+        return featurizer
 
     def reset(self):
         '''
@@ -95,17 +114,52 @@ class Featurizer():
             any featurization algorithm was run. If you want to rerun different
             featurization algorithms on the same instance, you'll need to call
             this first.
+
+            The intersectional closure of the input classes is only
+            calculated once, and kept in self.base_poset. Each reset gives
+            the featurization its own fork of it (see Poset.fork).
         '''
+        self.featurized = False
         self.class_features = defaultdict(set)
         self.segment_features = defaultdict(set)
         # Initialize to empty feature set for all segments
         for segment in self.alphabet:
             self.segment_features[segment]
+        # Inverted index of segment_features: maps each feature/value pair to
+        # a bitmask (see Poset.class_mask) of the segments that have it
+        self.feature_segments = defaultdict(int)
         self.feature_num = 1
+        # Timings and counters for this featurization (see Stats.py), shared
+        # with the poset
+        self.stats = Stats()
+        # Memoized results of get_class_features, keyed by class bitmask,
+        # along with the cached classes containing each segment (by segment
+        # bit) so entries can be invalidated when a segment's features change
+        self.class_feature_cache = {}
+        self.cached_classes_by_segment = defaultdict(set)
 
         # Build an intersectionally closed poset from the input classes
-        self.poset = Poset(self.alphabet, self.input_classes)
-        self.poset.get_intersectional_closure()
+        if self.base_poset is None:
+            self.base_poset = Poset(self.alphabet, self.input_classes,
+                                    engine=self.engine, stats=self.stats)
+            self.base_poset.get_intersectional_closure()
+        self.poset = self.base_poset.fork()
+        self.poset.stats = self.stats
+
+    def with_specification(self, specification):
+        '''
+            Creates a Featurizer for the same input classes but a different
+            specification, which shares this one's intersectional closure
+            rather than calculating it again.
+            
+            Input:
+                specification: The Specification for the new Featurizer
+        '''
+        return Featurizer(
+            self.input_classes, self.alphabet, specification,
+            verbose=self.verbose, rootname=self.rootname, engine=self.engine,
+            base_poset=self.base_poset
+        )
 
     def set_segment_features(self, c, feature):
         '''
@@ -118,6 +172,15 @@ class Featurizer():
         '''
         for segment in c:
             self.segment_features[segment].update(feature)
+        mask = self.poset.class_mask(c)
+        for f in feature:
+            self.feature_segments[f] |= mask
+
+        # Forget the cached features of any class containing these segments
+        for segment in c:
+            bit = self.poset.segment_bits[segment]
+            for class_mask in self.cached_classes_by_segment.pop(bit, ()):
+                self.class_feature_cache.pop(class_mask, None)
 
     def set_class_features(self, c, features):
         '''
@@ -133,16 +196,32 @@ class Featurizer():
         '''
             Gets all the feature/values assigned to a class.
             
+            Results are cached until set_segment_features changes the
+            features of one of the segments in c, so the returned set must not
+            be modified.
+            
             Input:
                 c: A set of strings
                 
             Returns:
                 The set of feature/value pairs assigned to c
         '''
-        return set.intersection(*[
+        mask = self.poset.class_mask(c)
+        if mask in self.class_feature_cache:
+            self.stats.count('class_feature_hits')
+            return self.class_feature_cache[mask]
+
+        self.stats.count('class_feature_misses')
+        features = set.intersection(*[
             self.segment_features.get(x, set()) for x in c
         ])
+        self.class_feature_cache[mask] = features
+        for segment in c:
+            bit = self.poset.segment_bits[segment]
+            self.cached_classes_by_segment[bit].add(mask)
+        return features
 
+    @timed
     def calculate_class_features(self):
         '''Calculate the featural description for each class in the poset'''
         for c in self.poset.classes:
@@ -161,7 +240,8 @@ class Featurizer():
             $ dot -Tsvg -O your_DOT_filename.gv
             
             Input:
-                filename: the file to write to (preferred extension: .gv)
+                filename: the file to write to (preferred extension: .gv, or
+                    .gv.gz to gzip it), or any object with a write method
                 kw_args: currently ignored (purpose: control graph style)
             '''
         if not filename:
@@ -171,6 +251,66 @@ class Featurizer():
             )
         self.poset.graph_poset(filename, kw_args)
     
+    def get_class_feature_masks(self):
+        '''
+            Gets the features of every class in the poset at once. Each
+            segment's features are encoded as a bitmask over feature/value
+            pairs (a row of the segment-by-feature incidence matrix), and a
+            class's features are the AND of the rows for its segments.
+            
+            Returns:
+                A list of ints, one per class in self.poset.classes, in which
+                the same bit always stands for the same feature/value pair
+        '''
+        feature_bits = {}
+        segment_masks = {}
+        for segment, features in self.segment_features.items():
+            mask = 0
+            for feature in features:
+                if feature not in feature_bits:
+                    feature_bits[feature] = 1 << len(feature_bits)
+                mask |= feature_bits[feature]
+            segment_masks[segment] = mask
+
+        all_features = (1 << len(feature_bits)) - 1
+        class_masks = []
+        for c in self.poset.classes:
+            mask = all_features
+            for segment in c:
+                mask &= segment_masks.get(segment, 0)
+            class_masks.append(mask)
+        return class_masks
+
+    def get_feature_transition_rows(self):
+        '''
+            Calculates the rows of the matrix returned by
+            get_feature_transitions as ints, where bit j of row i is M[i,j].
+            Rather than comparing the features of every pair of classes, this
+            uses the fact that class j has all the features of class i iff j
+            is in the set of classes having each feature of i.
+        '''
+        class_masks = self.get_class_feature_masks()
+        N = len(class_masks)
+
+        ## with_feature[f] = bitmask of the classes that have feature bit f
+        with_feature = defaultdict(int)
+        for j, mask in enumerate(class_masks):
+            while mask:
+                low = mask & -mask
+                with_feature[low] |= 1 << j
+                mask ^= low
+
+        full = (1 << N) - 1
+        rows = []
+        for i, mask in enumerate(class_masks):
+            row = full & ~(1 << i)
+            while mask:
+                low = mask & -mask
+                row &= with_feature[low]
+                mask ^= low
+            rows.append(row)
+        return rows
+
     def get_feature_transitions(self):
         '''
             This method should only be called after a featurization has been
@@ -181,19 +321,43 @@ class Featurizer():
                 M[i,j] = True ==> class j has a superset of features of class i            
         '''
         N = len(self.poset.classes)
-        
-        feature_transitions = ARRAY.zeros((N,N))
-        for i, cl_i in enumerate(self.poset.classes):
-            feats_i = self.get_class_features(cl_i)
-            for j, cl_j in enumerate(self.poset.classes):
-                if j <= i: continue
-                feats_j = self.get_class_features(cl_j)
-                ## check whether class j has superset of features of class i
-                feature_transitions[i,j] = feats_i.issubset(feats_j)
-                feature_transitions[j,i] = feats_j.issubset(feats_i)
-        
-        return feature_transitions
+        array = Array.get_engine(self.engine, N)
+        return array.from_rows(self.get_feature_transition_rows(), (N, N))
 
+    def get_feature_covers(self):
+        '''
+            Gets the links of the feature graph: the same relation as
+            M * ~(M . M) for M = get_feature_transitions(), but calculated
+            without a matrix product. j is a daughter of i iff M[i,j] and no
+            class k has M[i,k] and M[k,j], i.e. iff row i of M doesn't
+            intersect column j.
+            
+            Output:
+                A list containing, for each class i, the sorted indices of
+                its daughters
+        '''
+        rows = self.get_feature_transition_rows()
+        cols = [0] * len(rows)
+        for i, row in enumerate(rows):
+            while row:
+                low = row & -row
+                cols[low.bit_length() - 1] |= 1 << i
+                row ^= low
+
+        covers = []
+        for i, row in enumerate(rows):
+            daughters = []
+            remaining = row
+            while remaining:
+                low = remaining & -remaining
+                j = low.bit_length() - 1
+                if not row & cols[j]:
+                    daughters.append(j)
+                remaining ^= low
+            covers.append(daughters)
+        return covers
+
+    @timed
     def graph_feats(self, filename=None, kw_args=None):
         '''
             Creates a DOT file which describes a graph of the classes
@@ -206,25 +370,35 @@ class Featurizer():
             $ dot -Tsvg -O your_DOT_filename.gv
             
             Input:
-            filename: the file to write to (preferred extension: .gv)
+            filename: the file to write to (preferred extension: .gv, or
+                .gv.gz to gzip it), or any object with a write method (e.g.
+                sys.stdout or an io.StringIO)
             kw_args: currently ignored (purpose: control graph style)
         '''
-        
-        #################################################
-        ##                    SETUP                    ##
-        #################################################
-        
-        N = len(self.poset.classes)
-
         if not filename:
             inv_map = {v: k for k, v in FEATURIZATION_MAP.items()}
             filename = "../feats_output/{}_{}.gv".format(
                 self.rootname, inv_map[self.specification]
             )
+
+        if hasattr(filename, 'write'):
+            filename.writelines(self.iter_feats_graph())
+        else:
+            with open_output(filename) as fout:
+                fout.writelines(self.iter_feats_graph())
+
+    def iter_feats_graph(self):
+        '''
+            Generates the contents of the DOT file written by graph_feats, a
+            line (or, for the links, a single link) at a time
+        '''
         
-        ## write header (clearing old file if it exists)
-        with open(filename, 'w') as fout:
-            fout.write('// None\ndigraph {\n')
+        #################################################
+        ##                    SETUP                    ##
+        #################################################
+
+        ## write header
+        yield '// None\ndigraph {\n'
             
         #################################################
         ##                  GET NODES                  ##
@@ -244,22 +418,17 @@ class Featurizer():
                                                        node_string_infix,
                                                        feat_string,
                                                        node_string_suffix)
-            with open(filename, 'a') as fout:
-                fout.write('\t{0} {1}\n'.format(i, node_string))
+            yield '\t{0} {1}\n'.format(i, node_string)
 
         #################################################
         ##                  GET LINKS                  ##
         #################################################
 
-        ## m[i,j] = True iff class j is subset of class i
-        m = self.get_feature_transitions()
-        feature_daughter = m * ~ARRAY.dot(m, m)
-        
-        for i in range(N):
-            for j in range(N):
-                if feature_daughter[i,j]:
-                    with open(filename, 'a') as fout:
-                        fout.write('\t{0} -> {1}'.format(i,j))
+        ## links go from each class to the classes with a minimal superset
+        ## of its features (see get_feature_covers)
+        for i, daughters in enumerate(self.get_feature_covers()):
+            for j in daughters:
+                yield '\t{0} -> {1}'.format(i,j)
 
         #################################################
         ##                    WRAPUP                   ##
@@ -267,10 +436,7 @@ class Featurizer():
         
         singletons = [str(i) for i,c in enumerate(self.poset.classes) if len(c)==1]
         singleton_str = ' '.join(singletons)
-        with open(filename, 'a') as fout:
-            fout.write('\n{rank=same; ')
-            fout.write(singleton_str)
-            fout.write('}\n}')
+        yield '\n{rank=same; ' + singleton_str + '}\n}'
             
     def get_segments_for_feature(self, feature):
         '''
@@ -282,11 +448,17 @@ class Featurizer():
             Returns:
                 A set of segments
         '''
-        segments = set()
-        for segment, features in self.segment_features.items():
-            if feature in features:
-                segments.add(segment)
-        return segments
+        return self.poset.mask_class(self.feature_segments.get(feature, 0))
+
+    def get_mask_for_features(self, features):
+        '''
+            Like get_class_for_features, but returns the class as a bitmask
+            (see Poset.class_mask)
+        '''
+        mask = self.poset.class_mask(self.alphabet)
+        for feature in features:
+            mask &= self.feature_segments.get(feature, 0)
+        return mask
 
     def get_class_for_features(self, features):
         '''
@@ -298,22 +470,21 @@ class Featurizer():
             Returns:
                 A set representing the class specified by features
         '''
-        feature_segments = [self.alphabet]
-        for feature in features:
-            segments = self.get_segments_for_feature(feature)
-            feature_segments.append(segments)
-        return set.intersection(*feature_segments)
+        return self.poset.mask_class(self.get_mask_for_features(features))
 
+    @timed
     def assert_valid_featurization(self):
         '''Checks that the calculcated features pick out the expected classes'''
         for c, features in self.class_features.items():
-            predicted_class = self.get_class_for_features(features)
-            if predicted_class != set(c):
+            predicted_mask = self.get_mask_for_features(features)
+            if predicted_mask != self.poset.class_mask(c):
+                predicted_class = self.poset.mask_class(predicted_mask)
                 raise Exception(
                     "Invalid featurization: feature set {} associated with class {},"
                     "but produces class {}".format(features, set(c), predicted_class)
                 )
 
+    @timed
     def features_to_csv(self, filename=None):
         '''
             Creates a CSV with classes as rows and corresponding feautral
@@ -358,6 +529,7 @@ class Featurizer():
             print("{}:\t{}".format(key, sorted(value)))
         print() 
 
+    @timed
     def add_complement_classes(self):
         '''
             For the inferential complementary and full specifications, 
@@ -400,19 +572,31 @@ class Featurizer():
             new_children = self.poset.get_children(current_node)
             bfs_deque.extend(new_children)
 
+    @timed
     def featurize_classes(self):
+        '''
+            Featurize the currently calculated poset
+
+            Classes are processed in poset order. A class assigned the
+            negative value of a feature as a complement doesn't need to be
+            processed itself, so it's marked as done (a bit in an int indexed
+            by class position) rather than being removed from a queue.
+        '''
         if self.verbose:
             print("Classes to process: {}".format(self.poset.classes))
-        '''Featurize the currently calculated poset'''
-        incomplete_classes = self.poset.classes.copy()
+        classes = self.poset.classes
+        input_classes = set(frozenset(c) for c in self.input_classes)
+        done = 0
 
-        while incomplete_classes:
-            c = incomplete_classes.pop(0)
+        for i, c in enumerate(classes):
+            if done >> i & 1:
+                continue
             if self.verbose:
                 print("Processing class: {}".format(c))
             # We only need to do something if the current class has exactly
             # one parent
-            if len(self.poset.get_parents(c)) == 1:
+            parents = self.poset.get_parents(c)
+            if len(parents) == 1:
                 c_feature = set([(self.feature_num, '+')])
                 self.set_segment_features(c, c_feature)
 
@@ -424,22 +608,21 @@ class Featurizer():
                         c1 = self.alphabet - c
                     else:
                         # Otherwise take it wrt the parent set. 
-                        parent = self.poset.get_parents(c)[0]
-                        c1 = parent - c
+                        c1 = parents[0] - c
 
                     # We only want to consider the complement for inferential 
                     # complementary underspecification if it's in the input set.
                     if (self.specification != Specification.COMPLEMENTARY
-                            or c1 in self.input_classes):
+                            or frozenset(c1) in input_classes):
                         # Assign the negative value of the new feature to the 
                         # new class
                         c1_feature = set([(self.feature_num, '-')])
                         self.set_segment_features(c1, c1_feature)
 
-                        incomplete_classes = list(filter(
-                            lambda x: x != c1,
-                            incomplete_classes
-                        ))
+                        try:
+                            done |= 1 << self.poset.index(c1)
+                        except ValueError:
+                            pass
 
                 self.feature_num += 1
 
@@ -448,15 +631,23 @@ class Featurizer():
 
         self.calculate_class_features()
         self.assert_valid_featurization()
+        self.featurized = True
 
+    @timed
     def get_features_from_classes(self):
         '''
             Calculate the complements added by the featurization if any, and then
-            featurize the poset
+            featurize the poset. Does nothing if the poset has already been
+            featurized (e.g. if it was loaded from a cache); call reset first
+            to featurize it again.
         '''
+        if self.featurized:
+            return
         if self.specification in (Specification.INFERENTIAL_COMPLEMENTARY, Specification.FULL):
             self.add_complement_classes()
         self.featurize_classes()
+        if self.cache is not None:
+            self.cache.store(self)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -479,27 +670,77 @@ if __name__ == "__main__":
         help="Use numpy for matrix calculations. This will make the algorithm "
              "run faster, but requires numpy to be installed on your system."
     )
+    parser.add_argument(
+        '--engine', type=str, default=None, choices=sorted(Array.ENGINES),
+        help="The matrix engine to use. By default 'numpy' is used for large "
+             "posets if it is installed, and 'packed' otherwise. "
+             "--use_numpy is equivalent to --engine numpy."
+    )
     parser.add_argument(
         '--poset_file', type=str, default=None,
-        help='The path to the file to save the poset graph in.'
+        help="The path to the file to save the poset graph in, or '-' to "
+             "write it to stdout."
     )
     parser.add_argument(
         '--feats_file', type=str, default=None,
-        help='The path to the file to save the featurization graph in.'
+        help="The path to the file to save the featurization graph in, or "
+             "'-' to write it to stdout."
+    )
+    parser.add_argument(
+        '--cache_dir', type=str, default=None,
+        help='A directory in which to cache featurizations, so that inputs '
+             'which have been featurized before are loaded rather than '
+             'recalculated. By default nothing is cached.'
+    )
+    parser.add_argument(
+        '--cache_size', type=float, default=64,
+        help='The maximum size of the cache in megabytes. Least recently used '
+             'featurizations are deleted to stay under it.'
+    )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help="Record how long each phase of the featurization takes, how "
+             "often the expensive operations run, and peak memory use, and "
+             "print them at the end. Tracking memory slows the featurization "
+             "down."
+    )
+    parser.add_argument(
+        '--profile_file', type=str, default=None,
+        help="The path to the file to save the --profile stats in as JSON. "
+             "Implies --profile, but nothing is printed unless --profile is "
+             "also given."
     )
     parser.add_argument(
         '--verbose', action='store_true',
         help='Prints additional information throughout the course of the featurization.'
     )
     args = parser.parse_args()
+    if args.profile or args.profile_file:
+        import tracemalloc
+        tracemalloc.start()
     specification = FEATURIZATION_MAP.get(args.featurization, args.featurization)
+    cache = None
+    if args.cache_dir:
+        from Cache import FeaturizationCache
+        cache = FeaturizationCache(
+            args.cache_dir, int(args.cache_size * 1024 * 1024)
+        )
     featurizer = Featurizer.from_file(
         args.input_file, specification, use_numpy=args.use_numpy,
-        verbose=args.verbose
+        verbose=args.verbose, engine=args.engine, cache=cache
     )
     featurizer.get_features_from_classes()
     featurizer.print_featurization()
     featurizer.print_segment_features()
-    featurizer.graph_poset(args.poset_file)
-    featurizer.graph_feats(args.feats_file)
+    featurizer.graph_poset(
+        sys.stdout if args.poset_file == '-' else args.poset_file
+    )
+    featurizer.graph_feats(
+        sys.stdout if args.feats_file == '-' else args.feats_file
+    )
     featurizer.features_to_csv(args.output_file)
+    if args.profile:
+        featurizer.stats.print_stats()
+    if args.profile_file:
+        with open(args.profile_file, 'w') as f:
+            featurizer.stats.to_json(f)
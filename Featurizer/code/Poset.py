@@ -1,18 +1,11 @@
+import Array
+import copy
 import graphviz as gv
+import gzip
 import os
 
+from Stats import Stats, timed
 from collections import deque
-from itertools import compress
-
-# See the comment in the SimpleBoolArray class
-USE_NUMPY = False
-
-if USE_NUMPY:
-    import numpy as np
-    ARRAY = np
-else:
-    import Array
-    ARRAY = Array.SimpleBoolArray
 
 # file constants
 DEFAULT_OUTPUT_DIR = "../poset_output"
@@ -21,13 +14,30 @@ DEFAULT_OUTPUT_DIR = "../poset_output"
 ORIG_CLASS_NODE_SHAPE = "box"
 MULTI_PARENT_LINK_STYLE = "dotted"
 
+def open_output(filename):
+    '''
+    Opens a text file for writing, gzip-compressed if filename ends in .gz
+    '''
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'wt')
+    return open(filename, 'w')
+
 class Poset():
     def __init__(self, alphabet, input_classes=None,
-                 output_dir=DEFAULT_OUTPUT_DIR):
+                 output_dir=DEFAULT_OUTPUT_DIR, engine=None, stats=None,
+                 cover_relation=None):
         """
         input_classes: A list of lists or sets.
         output_dir: A string specifying where the graph visualizations
                     should be saved.
+        engine: The name of the matrix engine to use (see Array.get_engine).
+                If None, one is chosen based on the number of classes each
+                time the matrices are recalculated.
+        stats: The Stats object to record timings and counts in. If None,
+               the poset gets its own.
+        cover_relation: A tuple (<classes>, <child indices>) calculated
+                previously (see set_cover_relation). If given, the poset
+                is built from it without calculating anything.
         """
         if not input_classes:
             input_classes = []
@@ -40,13 +50,119 @@ class Poset():
         if self.alphabet not in self.classes:
             self.classes.append(self.alphabet)
         self.output_dir = output_dir
-        self.calculate_matrices()
+        self.engine = engine
+        self.stats = stats if stats is not None else Stats()
+        # Each segment gets a bit, so that classes can be represented as
+        # integer bitmasks (see class_mask)
+        self.segment_bits = {
+            segment: 1 << i for i, segment in enumerate(sorted(self.alphabet))
+        }
+        # True if the class lists and relations may be shared with a fork
+        self.shared = False
+        if cover_relation is None:
+            self.calculate_matrices()
+        else:
+            self.set_cover_relation(*cover_relation)
+
+    def fork(self):
+        """
+        Returns a copy of the poset that can be modified independently of
+        this one. The copy is cheap: the two posets share their classes and
+        relations until one of them adds classes, at which point that one
+        makes its own copies (see unshare).
+        """
+        other = copy.copy(self)
+        self.shared = True
+        other.shared = True
+        return other
+
+    def unshare(self):
+        """
+        Makes private copies of any structures that may be shared with
+        another poset via fork. Must be called before modifying them in place.
+        segment_bits stays shared, since it's only ever extended and every
+        fork should agree on which bit stands for which segment.
+        """
+        if not self.shared:
+            return
+        self.classes = list(self.classes)
+        self.masks = list(self.masks)
+        self.class_index = dict(self.class_index)
+        self.parent_indices = [list(p) for p in self.parent_indices]
+        self.child_indices = [list(c) for c in self.child_indices]
+        if self._subset_rows is not None:
+            self._subset_rows = list(self._subset_rows)
+        self.shared = False
 
     def calculate_matrices(self):
-        self.subset_matrix = None
-        self.daughter_matrix = None
-        self.calculate_subset_matrix()
-        self.calculate_daughter_matrix()
+        self.stats.count('matrix_rebuilds')
+        self.array = Array.get_engine(self.engine, len(self.classes))
+        self._subset_rows = None
+        self._subset_matrix = None
+        self._daughter_matrix = None
+        self.calculate_cover_relation()
+
+    @property
+    def subset_matrix(self):
+        """
+        The subset relation as a matrix (see calculate_subset_matrix). Only
+        calculated when it's first needed, since the parent/daughter
+        relationship doesn't depend on it.
+        """
+        if self._subset_matrix is None:
+            if self._subset_rows is None:
+                self.calculate_subset_matrix()
+            else:
+                n = len(self.classes)
+                self.array = Array.get_engine(self.engine, n)
+                self._subset_matrix = self.array.from_rows(
+                    self._subset_rows, (n, n)
+                )
+        return self._subset_matrix
+
+    def set_cover_relation(self, classes, child_indices):
+        """
+        Replaces the classes in the poset and their parent/daughter
+        relationship with ones that were calculated previously, e.g. by
+        another Poset for the same inputs.
+
+        classes: A list of sets
+        child_indices: For each class, the sorted indices of its children
+        """
+        self.unshare()
+        self.classes = classes
+        self.array = Array.get_engine(self.engine, len(classes))
+        self._subset_rows = None
+        self._subset_matrix = None
+        self._daughter_matrix = None
+        self.masks = [self.class_mask(c) for c in classes]
+        self.class_index = {}
+        for i, mask in enumerate(self.masks):
+            self.class_index.setdefault(mask, i)
+        self.child_indices = child_indices
+        self.parent_indices = [[] for c in classes]
+        for i, children in enumerate(child_indices):
+            for j in children:
+                self.parent_indices[j].append(i)
+
+    def class_mask(self, c):
+        """
+        Returns the bitmask of the segments in c
+        """
+        mask = 0
+        for segment in c:
+            if segment not in self.segment_bits:
+                self.segment_bits[segment] = 1 << len(self.segment_bits)
+            mask |= self.segment_bits[segment]
+        return mask
+
+    def mask_class(self, mask):
+        """
+        Returns the set of segments in a bitmask (the inverse of class_mask)
+        """
+        return {
+            segment for segment, bit in self.segment_bits.items() if mask & bit
+        }
 
     def add_classes(self, new_classes, update_closure=False):
         """
@@ -55,7 +171,10 @@ class Poset():
 
         Returns False if class was already in the poset, True otherwise
         """
-        new_classes = [x for x in new_classes if x not in self.classes]
+        self.unshare()
+        new_classes = [
+            x for x in new_classes if self.class_mask(x) not in self.class_index
+        ]
 
         if update_closure:
             # Update intersectional closure
@@ -67,24 +186,59 @@ class Poset():
             # Just add the class to the poset without recalculating the
             # intersectional closure.
             self.classes.extend(new_classes)
-            self.calculate_subset_matrix()
-            self.calculate_daughter_matrix()
+            self.calculate_matrices()
 
+    @timed
     def calculate_subset_matrix(self):
         """
-        Goes through every pair of sets in the inputs and determines whether
-        they are in a subset relation. If they are, set their cell in the
-        subset matrix to True (so M[j,i] = True means set_i < set_j).
+        Determines for every pair of sets in the inputs whether they are in
+        a subset relation. If they are, set their cell in the subset matrix
+        to True (so M[j,i] = True means set_i < set_j).
+
+        Rather than comparing every pair of sets, this first builds the
+        segment-by-class incidence matrix: for each segment, a bitmask of
+        the classes that contain it. Class i is a subset of class j iff i
+        contains no segment outside of j, so row j of M is the complement
+        of the union of the incidence rows for the segments outside of j.
         """
         n = len(self.classes)
-        self.subset_matrix = ARRAY.zeros((n, n), dtype='bool')
-        for i, c1 in enumerate(self.classes):
-            for j, c2 in enumerate(self.classes[i+1:], start=i+1):
-                if c1.issubset(c2):
-                    self.subset_matrix[j, i] = True
-                if c2.issubset(c1):
-                    self.subset_matrix[i, j] = True
+        containing = {bit: 0 for bit in self.segment_bits.values()}
+        for i, mask in enumerate(self.masks):
+            for bit in containing:
+                if mask & bit:
+                    containing[bit] |= 1 << i
 
+        full = (1 << n) - 1
+        self._subset_rows = []
+        for j, mask in enumerate(self.masks):
+            outside = 1 << j
+            for bit, classes in containing.items():
+                if not mask & bit:
+                    outside |= classes
+            self._subset_rows.append(full & ~outside)
+
+        self.array = Array.get_engine(self.engine, n)
+        self._subset_matrix = self.array.from_rows(self._subset_rows, (n, n))
+
+    def insert_subset_row(self, i):
+        """
+        Updates the subset relation for class i, which must be the most
+        recently added class, by comparing it against the other classes.
+        Does nothing if the subset matrix hasn't been calculated yet.
+        """
+        if self._subset_rows is None:
+            return
+        mask = self.masks[i]
+        row = 0
+        for j in range(i):
+            if self.masks[j] & ~mask == 0:
+                row |= 1 << j
+            if mask & ~self.masks[j] == 0:
+                self._subset_rows[j] |= 1 << i
+        self._subset_rows.append(row)
+        self._subset_matrix = None
+
+    @timed
     def calculate_daughter_matrix(self):
         """
         Calculate parent/daughter relationship:
@@ -98,73 +252,220 @@ class Poset():
         are in a direct parent-daughter relationship.
         """
         m = self.subset_matrix
-        self.daughter_matrix = m * ~ARRAY.dot(m, m)
+        self._daughter_matrix = m * ~self.array.dot(m, m)
+        n = len(self.classes)
+        self.child_indices = [
+            [j for j in range(n) if self._daughter_matrix[i, j]]
+            for i in range(n)
+        ]
+        self.parent_indices = [
+            [i for i in range(n) if self._daughter_matrix[i, j]]
+            for j in range(n)
+        ]
+
+    @timed
+    def calculate_cover_relation(self):
+        """
+        Calculates the same parent/daughter relationship as
+        calculate_daughter_matrix, but stores it as adjacency lists
+        (self.parent_indices and self.child_indices, both sorted by class
+        index) without ever building an n x n matrix product.
+
+        Classes are inserted from largest to smallest. Since a class can
+        only lie between two classes that are larger than it, the parent/
+        daughter links among the classes inserted so far are final. The
+        parents of a new class c are found by searching down from the roots
+        through classes that are supersets of c: the parents are the
+        supersets none of whose children are also supersets of c.
+        """
+        n = len(self.classes)
+        self.masks = masks = [self.class_mask(c) for c in self.classes]
+        self.class_index = {}
+        for i, mask in enumerate(masks):
+            self.class_index.setdefault(mask, i)
+        order = sorted(range(n), key=lambda i: (-len(self.classes[i]), i))
+        self.child_indices = [[] for i in range(n)]
+        self.parent_indices = [[] for i in range(n)]
+        roots = []
+
+        for i in order:
+            mask = masks[i]
+            # Strict supersets of class i
+            def above(j):
+                return masks[j] != mask and mask & ~masks[j] == 0
+
+            stack = [r for r in roots if above(r)]
+            seen = set(stack)
+            parents = []
+            while stack:
+                j = stack.pop()
+                lower = [k for k in self.child_indices[j] if above(k)]
+                if not lower:
+                    parents.append(j)
+                for k in lower:
+                    if k not in seen:
+                        seen.add(k)
+                        stack.append(k)
+
+            if not parents:
+                roots.append(i)
+            for j in parents:
+                self.child_indices[j].append(i)
+            self.parent_indices[i] = sorted(parents)
+
+        for children in self.child_indices:
+            children.sort()
+
+    def insert_cover(self, i):
+        """
+        Links class i, which must be the most recently added class, into the
+        parent/daughter adjacency lists of the other classes.
+
+        The parents of i are the minimal strict supersets of i. A superset is
+        minimal iff none of its children is also a superset of i (any chain
+        down to a smaller superset has to pass through one of its children).
+        The children of i are found the same way among its subsets. Any
+        existing link from a parent of i to a child of i now passes through
+        i, so it's removed.
+        """
+        self.stats.count('cover_inserts')
+        mask = self.masks[i]
+        above = set()
+        below = set()
+        for j, m in enumerate(self.masks):
+            if m == mask:
+                continue
+            if mask & ~m == 0:
+                above.add(j)
+            elif m & ~mask == 0:
+                below.add(j)
+
+        parents = sorted(
+            j for j in above
+            if not any(k in above for k in self.child_indices[j])
+        )
+        children = sorted(
+            j for j in below
+            if not any(k in below for k in self.parent_indices[j])
+        )
+        for j in parents:
+            for k in children:
+                if k in self.child_indices[j]:
+                    self.child_indices[j].remove(k)
+                    self.parent_indices[k].remove(j)
+
+        # i is the largest index, so appending keeps the lists sorted
+        for j in parents:
+            self.child_indices[j].append(i)
+        for k in children:
+            self.parent_indices[k].append(i)
+        self.parent_indices.append(parents)
+        self.child_indices.append(children)
+        self._daughter_matrix = None
+
+    @property
+    def daughter_matrix(self):
+        """
+        The parent/daughter relationship as a matrix, M[i,j] = True iff
+        class j is a daughter of class i. Built from the adjacency lists the
+        first time it's needed.
+        """
+        if self._daughter_matrix is None:
+            n = len(self.classes)
+            self._daughter_matrix = self.array.zeros((n, n), dtype='bool')
+            for i, children in enumerate(self.child_indices):
+                for j in children:
+                    self._daughter_matrix[i, j] = True
+        return self._daughter_matrix
+
+    def index(self, c):
+        """
+        Gets the position of the provided class in self.classes. Like
+        list.index, raises a ValueError if the class isn't in the poset, but
+        takes constant time with respect to the number of classes.
+        """
+        mask = 0
+        for segment in c:
+            if segment not in self.segment_bits:
+                raise ValueError("{} is not in the poset".format(c))
+            mask |= self.segment_bits[segment]
+        if mask not in self.class_index:
+            raise ValueError("{} is not in the poset".format(c))
+        return self.class_index[mask]
 
     def get_parents(self, c):
         """
         Gets the parents of the provided class
         """
-        index = self.classes.index(c)
-        parents_col = self.daughter_matrix[:, index]
-        return list(compress(self.classes, parents_col))
+        self.stats.count('get_parents')
+        index = self.index(c)
+        return [self.classes[i] for i in self.parent_indices[index]]
 
     def get_children(self, c):
         """
         Gets the children of the provided class
         """
-        index = self.classes.index(c)
-        children_col = self.daughter_matrix[index, :]
-        return list(compress(self.classes, children_col))
+        self.stats.count('get_children')
+        index = self.index(c)
+        return [self.classes[i] for i in self.child_indices[index]]
 
     def is_subset(self, c1, c2):
         """
         Returns True if c1 is a subset of c2, False otherwise
         """
-        i = self.classes.index(c1)
-        j = self.classes.index(c2)
-        return self.subset_matrix[j, i]
+        i = self.index(c1)
+        j = self.index(c2)
+        return i != j and self.masks[i] & ~self.masks[j] == 0
 
+    @timed
     def graph_poset(self, filename, kw_args=None):
         '''
         Creates and writes to a DOT file which represents the
-        parent/daughter relationships between classes in the poset 
+        parent/daughter relationships between classes in the poset. If
+        filename ends in .gz, the file is gzip-compressed. filename can also
+        be any object with a write method (e.g. sys.stdout).
         '''
-        
-        linebuf = []
-        linebuf.append('// None')
-        linebuf.append('digraph {')
+        if hasattr(filename, 'write'):
+            self.write_graph(filename)
+        else:
+            with open_output(filename) as fout:
+                self.write_graph(fout)
+
+    def write_graph(self, fout):
+        '''
+        Writes the DOT representation of the poset to an open file, a line
+        at a time. Links are read straight from the adjacency lists.
+        '''
+        fout.write('// None\n')
+        fout.write('digraph {\n')
 
         # get nodes
+        input_masks = set(self.class_mask(c) for c in self.input_classes)
         for i, cl in enumerate(self.classes):
             attributes = {'label': '"' + ', '.join(cl) + '"'}
-            if cl in self.input_classes:
+            if self.masks[i] in input_masks:
                 attributes['shape'] = ORIG_CLASS_NODE_SHAPE
             attrStr = ','.join([
                 '{0}={1}'.format(attr, val) 
                 for attr, val in attributes.items()
             ])
-            linebuf.append('\t{0} [{1}]'.format(i,attrStr))
+            fout.write('\t{0} [{1}]\n'.format(i,attrStr))
         
         # get links
-        for i in range(len(self.classes)):
-            for j in range(len(self.classes)):
-                if self.daughter_matrix[i,j]:
-                    attributes = {}
-                    if len(self.get_parents(self.classes[j])) > 1:
-                        attributes['style'] = MULTI_PARENT_LINK_STYLE
-                    attrStr = ','.join([
-                        '{0}={1}'.format(attr, val)
-                        for attr, val in attributes.items()
-                    ])
-                    linebuf.append('\t{0} -> {1} [{2}]'.format(i, j, attrStr))
+        for i, children in enumerate(self.child_indices):
+            for j in children:
+                attributes = {}
+                if len(self.parent_indices[j]) > 1:
+                    attributes['style'] = MULTI_PARENT_LINK_STYLE
+                attrStr = ','.join([
+                    '{0}={1}'.format(attr, val)
+                    for attr, val in attributes.items()
+                ])
+                fout.write('\t{0} -> {1} [{2}]\n'.format(i, j, attrStr))
                     
-        linebuf.append('}')
-        
-        with open(filename, 'w') as fout:
-            for line in linebuf:
-                fout.write(line)
-                fout.write('\n')
+        fout.write('}\n')
 
+    @timed
     def get_intersectional_closure(self, existing_closure=None,
                                    new_classes=None):
         """
@@ -172,19 +473,62 @@ class Poset():
             1.  All classes in self are also in p
             2.  The intersections of all subsets of the sets in self
                 are also in p
+
+        Classes are compared as bitmasks (see class_mask), so checking
+        whether a class is already in the closure or waiting to be added
+        takes constant time, and each new class is intersected only with the
+        classes in the closure when it is added. If existing_closure is the
+        current list of classes, the new classes are linked into the
+        existing parent/daughter relationship one at a time rather than
+        recalculating it from scratch.
         """
+        incremental = existing_closure is self.classes
+        if incremental:
+            self.unshare()
+            existing_closure = self.classes
         closure_classes = existing_closure or [self.alphabet]
-        class_deque = deque(new_classes) if new_classes else deque(self.classes)
+        if incremental:
+            # The current classes are already in the closure, so only
+            # new_classes need to be considered
+            closure_masks = list(self.masks)
+            candidates = new_classes or []
+        else:
+            closure_masks = [self.class_mask(c) for c in closure_classes]
+            candidates = new_classes or self.classes
+        first_new = len(closure_classes)
+
+        # seen contains every class in the closure or waiting in the queue,
+        # so each class is only queued once
+        seen = set(closure_masks)
+        class_deque = deque()
+        for c in candidates:
+            mask = self.class_mask(c)
+            if mask not in seen:
+                seen.add(mask)
+                class_deque.append((c, mask))
 
+        intersections = 0
         while class_deque:
-            c = class_deque.popleft()
-            if c not in closure_classes:
-                for cc in closure_classes:
-                    intersection = c.intersection(cc)
-                    # Don't include the empty set
-                    if intersection:
-                        class_deque.append(c.intersection(cc))
-                closure_classes.append(c)
+            c, mask = class_deque.popleft()
+            intersections += len(closure_masks)
+            for cc, cc_mask in zip(closure_classes, closure_masks):
+                intersection = mask & cc_mask
+                # Don't include the empty set
+                if intersection and intersection not in seen:
+                    seen.add(intersection)
+                    class_deque.append((c.intersection(cc), intersection))
+            closure_classes.append(c)
+            closure_masks.append(mask)
 
+        self.stats.count('closure_intersections', intersections)
+        self.stats.count('closure_classes_added',
+                         len(closure_classes) - first_new)
         self.classes = closure_classes
-        self.calculate_matrices()
+        if incremental:
+            for i in range(first_new, len(closure_classes)):
+                self.masks.append(closure_masks[i])
+                self.class_index[closure_masks[i]] = i
+                self.insert_cover(i)
+                self.insert_subset_row(i)
+        else:
+            self.calculate_matrices()
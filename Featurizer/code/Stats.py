@@ -0,0 +1,125 @@
+import json
+import time
+import tracemalloc
+
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+def timed(method):
+    '''
+        Decorator for methods of objects with a stats attribute, which records
+        each call of the method as a phase named after it (see Stats.phase).
+    '''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.stats.phase(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class Stats():
+    """
+    Instrumentation for a featurization: how long each phase took and how
+    often it ran, counters of the expensive operations within them, and, if
+    tracemalloc is tracing, the peak memory allocated during each phase.
+
+    Phases can be nested; a phase's time and peak memory include those of
+    any phases it calls. A Featurizer and its Posets share one Stats object.
+
+    tracemalloc.reset_peak only exists from Python 3.9. Before that, a
+    phase's peak is the highest memory use since tracing started, so it
+    also counts whatever ran before the phase.
+    """
+    def __init__(self):
+        self.durations = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.peaks = {}
+        self.counters = defaultdict(int)
+        # The peak memory seen so far in each phase that's in progress
+        self._peak_stack = []
+
+    @contextmanager
+    def phase(self, name):
+        '''Records the time (and peak memory) of the enclosed block'''
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            # tracemalloc only keeps one peak, so save the enclosing phase's
+            # peak before resetting it for this one
+            if self._peak_stack:
+                self._peak_stack[-1] = max(
+                    self._peak_stack[-1], tracemalloc.get_traced_memory()[1]
+                )
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self._peak_stack.append(0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] += time.perf_counter() - start
+            self.calls[name] += 1
+            if tracing:
+                peak = max(
+                    self._peak_stack.pop(), tracemalloc.get_traced_memory()[1]
+                )
+                self.peaks[name] = max(self.peaks.get(name, 0), peak)
+                if self._peak_stack:
+                    self._peak_stack[-1] = max(self._peak_stack[-1], peak)
+
+    def count(self, name, n=1):
+        '''Adds n to a counter'''
+        self.counters[name] += n
+
+    def peak_memory(self):
+        '''The peak memory allocated in any phase, or None if not tracing'''
+        if not self.peaks and not tracemalloc.is_tracing():
+            return None
+        peaks = list(self.peaks.values())
+        if tracemalloc.is_tracing():
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        return max(peaks)
+
+    def as_dict(self):
+        '''
+            Returns:
+                A dict of the form
+                {
+                    'phases': {<name>: {'seconds': ..., 'calls': ...,
+                                        'peak_bytes': ...}, ...},
+                    'counters': {<name>: <count>, ...},
+                    'peak_bytes': <peak memory or None>
+                }
+        '''
+        return {
+            'phases': {
+                name: {
+                    'seconds': self.durations[name],
+                    'calls': self.calls[name],
+                    'peak_bytes': self.peaks.get(name),
+                }
+                for name in self.durations
+            },
+            'counters': dict(self.counters),
+            'peak_bytes': self.peak_memory(),
+        }
+
+    def to_json(self, f):
+        '''Writes the stats to an open file as JSON'''
+        json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+        f.write('\n')
+
+    def print_stats(self, f=None):
+        '''Prints a table of the phases, slowest first, and the counters'''
+        print('Phases', file=f)
+        for name in sorted(self.durations, key=lambda n: -self.durations[n]):
+            line = '{:<32}{:>10.4f}s{:>8} calls'.format(
+                name, self.durations[name], self.calls[name]
+            )
+            if name in self.peaks:
+                line += '{:>12.1f} KiB peak'.format(self.peaks[name] / 1024)
+            print(line, file=f)
+        print(file=f)
+        print('Counters', file=f)
+        for name, count in sorted(self.counters.items()):
+            print('{:<32}{:>10}'.format(name, count), file=f)
+        print(file=f)
@@ -0,0 +1,134 @@
+'''
+Checks FeaturizationCache: that a cached featurization is rebuilt exactly,
+that damaged entries are treated as misses rather than errors, and that
+the least recently used entries are evicted first. Run it as a script
+from this directory, or with `python -m pytest --import-mode=importlib`
+(see test__csv_output.py).
+'''
+
+import os
+import sys
+import tempfile
+
+from Cache import FeaturizationCache, FILE_EXTENSION
+from Featurizer import Featurizer, FEATURIZATION_MAP
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+INPUT_FILE = os.path.join(CODE_DIR, '..', 'sample_inputs', 'toy_system.txt')
+
+def featurize(cache, featurization='complementary'):
+    '''Featurizes the toy system, through the cache'''
+    featurizer = Featurizer.from_file(
+        INPUT_FILE, FEATURIZATION_MAP[featurization], cache=cache
+    )
+    featurizer.get_features_from_classes()
+    return featurizer
+
+def entries(cache):
+    '''The paths of the entries in a cache directory'''
+    return sorted(
+        os.path.join(cache.directory, name)
+        for name in os.listdir(cache.directory)
+        if name.endswith(FILE_EXTENSION)
+    )
+
+def summary(featurizer):
+    '''What a featurizer rebuilt from the cache must reproduce'''
+    return (
+        [sorted(c) for c in featurizer.poset.classes],
+        featurizer.poset.child_indices,
+        {s: sorted(f) for s, f in featurizer.segment_features.items()},
+        featurizer.feature_num,
+    )
+
+def test_round_trip():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for featurization in sorted(FEATURIZATION_MAP):
+            cache = FeaturizationCache(tmp_dir)
+            calculated = featurize(cache, featurization)
+            loaded = featurize(cache, featurization)
+            assert (cache.hits, cache.misses) == (1, 1), featurization
+            assert loaded is not calculated
+            assert loaded.featurized
+            assert summary(loaded) == summary(calculated), featurization
+
+def check_damaged_entry(damage):
+    '''Checks that an entry damaged by damage(data) is replaced on a miss'''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = FeaturizationCache(tmp_dir)
+        expected = summary(featurize(cache))
+        (filename,) = entries(cache)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        with open(filename, 'wb') as f:
+            f.write(damage(data))
+
+        cache = FeaturizationCache(tmp_dir)
+        assert summary(featurize(cache)) == expected
+        assert (cache.hits, cache.misses) == (0, 1)
+        # The entry was rewritten by the recalculation
+        cache = FeaturizationCache(tmp_dir)
+        featurize(cache)
+        assert (cache.hits, cache.misses) == (1, 0)
+
+def flip_bit(data):
+    middle = len(data) * 3 // 4
+    return data[:middle] + bytes([data[middle] ^ 0x10]) + data[middle + 1:]
+
+def test_truncated_entry():
+    check_damaged_entry(lambda data: data[:-6])
+
+def test_flipped_bit():
+    check_damaged_entry(flip_bit)
+
+def test_bad_header():
+    check_damaged_entry(lambda data: b'XXXX' + data[4:])
+
+def test_empty_entry():
+    check_damaged_entry(lambda data: b'')
+
+def test_deleted_entry():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = FeaturizationCache(tmp_dir)
+        featurize(cache)
+        for filename in entries(cache):
+            os.remove(filename)
+        featurize(cache)
+        assert (cache.hits, cache.misses) == (0, 2)
+        # Evicting entries another process has already deleted
+        cache.max_bytes = 0
+        os.remove(entries(cache)[0])
+        cache.evict()
+
+def test_eviction():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = FeaturizationCache(tmp_dir)
+        names = ['privative', 'complementary', 'full']
+        filenames = {}
+        for i, featurization in enumerate(names):
+            featurize(cache, featurization)
+            (filename,) = set(entries(cache)) - set(filenames.values())
+            filenames[featurization] = filename
+            os.utime(filename, (1000 * (i + 1), 1000 * (i + 1)))
+        # Using the oldest entry makes complementary the least recently used
+        featurize(cache, 'privative')
+        assert cache.hits == 1
+        kept = [filenames['privative'], filenames['full']]
+        cache.max_bytes = sum(os.path.getsize(f) for f in kept)
+        cache.evict()
+        assert entries(cache) == sorted(kept)
+
+if __name__ == "__main__":
+    failures = 0
+    tests = [
+        test_round_trip, test_truncated_entry, test_flipped_bit,
+        test_bad_header, test_empty_entry, test_deleted_entry, test_eviction,
+    ]
+    for test in tests:
+        try:
+            test()
+            print("ok\t{}".format(test.__name__))
+        except AssertionError as e:
+            failures += 1
+            print("FAILED\t{}: {}".format(test.__name__, e))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,63 @@
+'''
+Checks that featurizing the sample inputs still produces the committed
+CSVs in csv_output. Rows are written in an order that depends on set
+iteration order (and so on PYTHONHASHSEED), so they're compared
+ignoring order; the header, and so the feature numbering, must match
+exactly. Run it as a script from this directory, or with
+`python -m pytest --import-mode=importlib` (this directory is named
+'code', which clashes with the standard library module when pytest
+imports it as a package).
+'''
+
+import os
+import sys
+import tempfile
+
+from Featurizer import Featurizer, FEATURIZATION_MAP
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+INPUT_DIR = os.path.join(CODE_DIR, '..', 'sample_inputs')
+CSV_DIR = os.path.join(CODE_DIR, '..', 'csv_output')
+INPUTS = ['toy_system', 'paper_vowels']
+
+def read_csv(filename):
+    '''Gets the header and the set of rows of a featurization CSV'''
+    with open(filename, 'r') as f:
+        lines = f.read().splitlines()
+    return lines[0], sorted(lines[1:])
+
+def featurize_to_csv(rootname, featurization, filename):
+    featurizer = Featurizer.from_file(
+        os.path.join(INPUT_DIR, rootname + '.txt'),
+        FEATURIZATION_MAP[featurization]
+    )
+    featurizer.get_features_from_classes()
+    featurizer.features_to_csv(filename)
+
+def check_csv_output(rootname, featurization):
+    '''Raises an AssertionError if the output differs from the committed CSV'''
+    expected = os.path.join(
+        CSV_DIR, '{}_{}.csv'.format(rootname, featurization)
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        actual = os.path.join(tmp_dir, 'features.csv')
+        featurize_to_csv(rootname, featurization, actual)
+        assert read_csv(actual) == read_csv(expected), \
+            '{} differs from {}'.format(rootname, expected)
+
+def test_csv_output():
+    for rootname in INPUTS:
+        for featurization in sorted(FEATURIZATION_MAP):
+            check_csv_output(rootname, featurization)
+
+if __name__ == "__main__":
+    failures = 0
+    for rootname in INPUTS:
+        for featurization in sorted(FEATURIZATION_MAP):
+            try:
+                check_csv_output(rootname, featurization)
+                print("ok\t{}\t{}".format(rootname, featurization))
+            except AssertionError as e:
+                failures += 1
+                print("FAILED\t{}\t{}: {}".format(rootname, featurization, e))
+    sys.exit(1 if failures else 0)